@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+
+import re
+import sys
+import json
+import time
+import zlib
+import random
+import argparse
+import platform
+import resource
+from argparse import Namespace
+
+import generate
+from generate import Preprocessor, SuggestionTree, Scorer, ScoreCache, BrownClusterIndex, BufferWriter, \
+    Profiler, CandidateCache, CompoundSplitter, load_vocabulary, load_deletion_index
+
+
+def oov_tokens(path, spelling, limit=None):
+    """Yields the OOV tokens of a file with tweets, in the order they appear."""
+    count = 0
+    with open(path, 'r', encoding='utf-8', newline='\n') as f:
+        for line in f:
+            for token in Preprocessor.preprocess(line.split()):
+                if not re.search(r'[a-zA-Z]', token) or Preprocessor.is_emoticon(token):
+                    continue
+                if re.match(r"<[UR]>", token) or token[:1] == '#' or token[:1] == '@' or 'http' in token:
+                    continue
+                if spelling.contains_word(token):
+                    continue
+                yield token
+                count += 1
+                if limit and count >= limit:
+                    return
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def typo_candidates(engine, token):
+    # Same fallback as clean()
+    suggestions = engine.suggest(token, 1)
+    if not suggestions:
+        suggestions = engine.suggest(token, 2)
+    return suggestions
+
+
+def compare_candidates(args):
+    start = time.perf_counter()
+    spelling = load_vocabulary(args.vocabulary)
+    print('Vocabulary tree built in {:.2f}s'.format(time.perf_counter() - start))
+    start = time.perf_counter()
+    deletions = load_deletion_index(args.vocabulary)
+    print('Deletion index built in {:.2f}s'.format(time.perf_counter() - start))
+
+    tokens = list(oov_tokens(args.data, spelling, args.limit))
+    print('{} OOV tokens ({} unique)'.format(len(tokens), len(set(tokens))))
+
+    results = dict()
+    for name, engine in (('tree', spelling), ('deletions', deletions)):
+        latencies = list()
+        suggestions = list()
+        for token in tokens:
+            start = time.perf_counter()
+            suggestions.append(typo_candidates(engine, token))
+            latencies.append(time.perf_counter() - start)
+        results[name] = suggestions
+        total = sum(latencies)
+        print('{:>10}: {:.2f}s, {:.0f} tokens/s, p50 {:.3f}ms, p90 {:.3f}ms, p99 {:.3f}ms, max {:.3f}ms'.format(
+                name,
+                total,
+                len(tokens) / total if total else 0,
+                percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.9) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                max(latencies) * 1000))
+
+    differences = [token for token, tree_suggestions, index_suggestions in zip(
+                       tokens, results['tree'], results['deletions'])
+                   if tree_suggestions != index_suggestions]
+    print('{} tokens with different candidates'.format(len(differences)))
+    for token in sorted(set(differences))[:10]:
+        print('  {}'.format(token))
+
+
+def timed(function, inputs):
+    results = list()
+    latencies = list()
+    for value in inputs:
+        start = time.perf_counter()
+        results.append(function(value))
+        latencies.append(time.perf_counter() - start)
+    return results, latencies
+
+
+def compare_neighbours(args):
+    # Imported here, so the other benchmarks run without the compiled library
+    from embeddings import Embeds
+    embeddings = Embeds()
+    embeddings.loadW2V(args.w2v)
+    if args.index:
+        if not embeddings.loadIndex(args.index):
+            sys.exit(1)
+    else:
+        start = time.perf_counter()
+        embeddings.buildIndex(args.trees)
+        print('Neighbour index with {} trees built in {:.2f}s'.format(args.trees, time.perf_counter() - start))
+    words = random.Random(args.seed).sample(embeddings.vocabulary[1:], min(args.sample, len(embeddings.vocabulary) - 1))
+
+    exact, latencies = timed(lambda word: embeddings.search(word, exact=True), words)
+    exact_mean = sum(latencies) / len(latencies)
+    print('{:>10}: recall 1.000, mean {:.3f}ms, p50 {:.3f}ms, p99 {:.3f}ms'.format(
+            'exact', exact_mean * 1000, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000))
+    for search_k in args.search_k:
+        embeddings.setSearchK(search_k)
+        approximate, latencies = timed(embeddings.search, words)
+        # Fraction of the exact neighbours which are found
+        recall = sum(len({word for word, _ in found} & {word for word, _ in expected})
+                     for found, expected in zip(approximate, exact)) / sum(len(expected) for expected in exact)
+        mean = sum(latencies) / len(latencies)
+        print('{:>10}: recall {:.3f}, mean {:.3f}ms, p50 {:.3f}ms, p99 {:.3f}ms, {:.1f}x faster'.format(
+                search_k or 'default', recall, mean * 1000, percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.99) * 1000, exact_mean / mean))
+
+
+class StandInState:
+    """Replaces kenlm.State: the last two words."""
+
+    def __init__(self):
+        self.words = ()
+
+
+class StandInModel:
+    """
+    Replaces kenlm.Model, so the suite runs without a language model. Every
+    word has a fixed, pseudo-random cost given the previous word, which keeps
+    the scores (and thereby the selected candidates) the same across runs and
+    machines.
+    """
+
+    order = 3
+
+    def BeginSentenceWrite(self, state):
+        state.words = ('<s>',)
+
+    def NullContextWrite(self, state):
+        state.words = ()
+
+    def BaseScore(self, state, word, out_state):
+        out_state.words = (state.words + (word,))[-2:]
+        previous_word = state.words[-1] if state.words else ''
+        return -1 - (zlib.crc32('{} {}'.format(previous_word, word).encode('utf-8')) % 1000) / 250
+
+
+class StandInEmbeds:
+    """
+    Replaces embeddings.Embeds: the neighbours of a word are a fixed,
+    pseudo-random selection of the given words.
+    """
+
+    num_candidates = 40
+
+    def __init__(self, words):
+        self.words = words
+
+    def find(self, word):
+        offset = zlib.crc32(word.encode('utf-8'))
+        return [self.words[(offset + i * 7919) % len(self.words)] for i in range(self.num_candidates)]
+
+
+def small_vocabulary(path, size, seed):
+    with open(path, 'r', encoding='utf-8', newline='\n') as f:
+        words = [line.rstrip() for line in f]
+    return sorted(random.Random(seed).sample(words, min(size, len(words))))
+
+
+def cluster_words(paths, vocabulary):
+    """The words in the Brown clusters which are not in the vocabulary."""
+    vocabulary = set(vocabulary)
+    words = list()
+    with open(paths, 'r', encoding='utf-8', newline='\n') as f:
+        for line in f:
+            word = line.split('\t')[1]
+            if word not in vocabulary and re.fullmatch(r"[a-z][a-z']+", word):
+                words.append(word)
+    return words
+
+
+def misspell(word, rng):
+    if len(word) < 3:
+        return word
+    i = rng.randrange(1, len(word) - 1)
+    edit = rng.randrange(4)
+    if edit == 0:
+        return word[:i] + word[i+1:]
+    if edit == 1:
+        return word[:i] + rng.choice('abcdefghijklmnopqrstuvwxyz') + word[i+1:]
+    if edit == 2:
+        return word[:i-1] + word[i] + word[i-1] + word[i+1:]
+    return word[:i] + word[i] * rng.randrange(2, 5) + word[i+1:]
+
+
+def synthetic_tweets(vocabulary, oov_words, count, seed):
+    """
+    Tweets of vocabulary words, with a Zipf-like word distribution, and
+    misspellings, lengthening, OOV cluster words, names, users, hashtags,
+    urls and emoticons mixed in.
+    """
+    rng = random.Random(seed)
+    words = [word for word in vocabulary if word.isalpha()]
+    rng.shuffle(words)
+    weights = [1 / rank for rank in range(1, len(words) + 1)]
+    for _ in range(count):
+        tokens = list()
+        for word in rng.choices(words, weights, k=rng.randrange(4, 20)):
+            noise = rng.random()
+            if noise < 0.05:
+                word = misspell(word, rng)
+            elif noise < 0.08 and oov_words:
+                word = rng.choice(oov_words)
+            elif noise < 0.09:
+                word = word.capitalize()
+            elif noise < 0.10:
+                word = rng.choice(['@user', '#' + word, 'http://t.co/' + word, ':)', ':D', '<3', '!!', '?'])
+            tokens.append(word)
+        yield ' '.join(tokens)
+
+
+def peak_rss():
+    """Peak resident set size of this process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(results, name, function, inputs):
+    """Times function on every input, and stores throughput and latency percentiles under name."""
+    latencies = list()
+    clock = time.perf_counter
+    for arguments in inputs:
+        start = clock()
+        function(*arguments)
+        latencies.append(clock() - start)
+    record(results, name, latencies)
+
+
+def record(results, name, latencies):
+    total = sum(latencies)
+    results[name] = {'operations': len(latencies),
+                     'seconds': total,
+                     'operations per second': len(latencies) / total if total else 0,
+                     'p50 ms': percentile(latencies, 0.5) * 1000,
+                     'p90 ms': percentile(latencies, 0.9) * 1000,
+                     'p99 ms': percentile(latencies, 0.99) * 1000,
+                     'max ms': max(latencies) * 1000,
+                     'peak rss MB': peak_rss()}
+    print('{:>40}: {:>10.0f} ops/s, p50 {:.3f}ms, p90 {:.3f}ms, p99 {:.3f}ms, peak RSS {:.0f}MB'.format(
+            name,
+            results[name]['operations per second'],
+            results[name]['p50 ms'],
+            results[name]['p90 ms'],
+            results[name]['p99 ms'],
+            results[name]['peak rss MB']), file=sys.stderr)
+
+
+def install_resources(spelling, splitter, clusters, noisy_clusters, embeddings):
+    """Sets the globals of generate which clean() and noisify() use, as load_resources() would."""
+    generate.args = Namespace(allow_compounds=False, debug=False, lm_context=1)
+    generate.profiler = Profiler()
+    generate.candidate_cache = CandidateCache()
+    generate.language_model = StandInModel()
+    generate.lm_scores = ScoreCache(generate.language_model, state_class=StandInState)
+    generate.distance_scorer = Scorer(generate.lm_scores)
+    generate.embeddings = embeddings
+    generate.spelling = spelling
+    generate.splitter = splitter
+    generate.typos = spelling
+    generate.clusters = clusters
+    generate.noisy_clusters = noisy_clusters
+    generate.out_noisy = BufferWriter()
+    generate.out_clean = BufferWriter()
+
+
+def run_suite(args):
+    settings = {'tweets': args.tweets,
+                'vocabulary size': args.vocabulary_size,
+                'seed': args.seed}
+    results = dict()
+
+    vocabulary = small_vocabulary(args.vocabulary, args.vocabulary_size, args.seed)
+    oov_words = cluster_words(args.paths, vocabulary)
+    tweets = list(synthetic_tweets(vocabulary, oov_words, args.tweets, args.seed))
+    token_lists = [Preprocessor.preprocess(tweet.split()) for tweet in tweets]
+    tokens = [token for token_list in token_lists for token in token_list]
+
+    spelling = SuggestionTree(ignore_case=True)
+    measure(results, 'SuggestionTree.add_word', spelling.add_word, ((word,) for word in vocabulary))
+    measure(results, 'SuggestionTree.contains_word', spelling.contains_word, ((token,) for token in tokens))
+    oov_tokens = [token for token in tokens if re.fullmatch(r"[a-zA-Z']+", token)
+                  and not spelling.contains_word(token)]
+    measure(results, 'SuggestionTree.suggest', spelling.suggest, ((token, 1) for token in oov_tokens))
+
+    reversed_spelling = SuggestionTree()
+    for word in vocabulary:
+        reversed_spelling.add_word(word.lower()[::-1])
+    splitter = CompoundSplitter(spelling, reversed_spelling)
+    measure(results, 'CompoundSplitter.find_splits', splitter.find_splits, ((token,) for token in tokens))
+
+    typo_pairs = [(token, suggestion) for token in oov_tokens[:2000]
+                  for suggestion in sorted(typo_candidates(spelling, token))]
+    measure(results, 'Scorer.levenshtein', Scorer.levenshtein, typo_pairs)
+
+    cluster_index = BrownClusterIndex.build(args.paths, spelling)
+    clusters = cluster_index.view(force_oov=False)
+    noisy_clusters = cluster_index.view(force_oov=True)
+    abbreviations = [(token, suggestions) for token, suggestions in
+                     ((token, clusters.suggest(token)) for token in oov_tokens) if suggestions]
+    measure(results, 'Scorer.abbreviation_best_matches', Scorer.abbreviation_best_matches, abbreviations)
+    for token, _ in abbreviations:
+        clusters.abbreviations(token)
+    measure(results, 'AbbreviationIndex.best_matches',
+            lambda token, suggestions: clusters.abbreviations(token).best_matches(token, 0.7), abbreviations)
+
+    measure(results, 'Preprocessor.preprocess', Preprocessor.preprocess, ((tweet.split(),) for tweet in tweets))
+
+    install_resources(spelling, splitter, clusters, noisy_clusters, StandInEmbeds(vocabulary + oov_words))
+    latencies = {'clean': list(), 'noisify': list()}
+    clock = time.perf_counter
+    for tweet in tweets:
+        counts = generate.profiler.counts
+        oov_count = counts['OOV tokens']
+        start = clock()
+        generate.process_tweet(tweet)
+        latency = clock() - start
+        latencies['clean' if counts['OOV tokens'] > oov_count else 'noisify'].append(latency)
+    for mode in ('clean', 'noisify'):
+        if latencies[mode]:
+            record(results, 'end-to-end ' + mode, latencies[mode])
+    record(results, 'end-to-end tweets', latencies['clean'] + latencies['noisify'])
+
+    report = {'python': platform.python_version(),
+              'platform': platform.platform(),
+              'settings': settings,
+              'results': results}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        return compare_reports(baseline, report, args.tolerance)
+    return True
+
+
+def compare_reports(baseline, report, tolerance):
+    """Prints the change in throughput per benchmark, and returns whether none got slower than tolerance."""
+    if baseline['settings'] != report['settings']:
+        print('Warning: the baseline was made with different settings: {}'.format(baseline['settings']))
+    passed = True
+    for name, result in sorted(report['results'].items()):
+        if name not in baseline['results']:
+            print('{:>40}: not in baseline'.format(name))
+            continue
+        before = baseline['results'][name]['operations per second']
+        after = result['operations per second']
+        change = after / before - 1 if before else 0
+        regression = change < -tolerance
+        passed = passed and not regression
+        print('{:>40}: {:>10.0f} -> {:>10.0f} ops/s ({:+.1%}){}'.format(
+                name, before, after, change, '  REGRESSION' if regression else ''))
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+    candidates = subparsers.add_parser('candidates',
+                                       help='Compare the typo candidate engines on the OOV tokens of a data file')
+    candidates.add_argument('--vocabulary',
+                            help='A list containing IV words',
+                            required=True)
+    candidates.add_argument('--data',
+                            help='The file containing (tokenized) tweets',
+                            required=True)
+    candidates.add_argument('--limit',
+                            type=int,
+                            help='Maximum number of OOV tokens to use')
+    neighbours = subparsers.add_parser('neighbours',
+                                       help='Compare the neighbour index with exact search on a sample of words')
+    neighbours.add_argument('--w2v',
+                            help='Binary word2vec model',
+                            required=True)
+    neighbours.add_argument('--index',
+                            help='Neighbour index built for the model (built on the fly if not given)')
+    neighbours.add_argument('--trees',
+                            type=int,
+                            default=10,
+                            help='Number of trees, when building the index')
+    neighbours.add_argument('--search-k',
+                            type=int,
+                            nargs='+',
+                            default=[0, 2000, 5000, 10000, 20000],
+                            help='Values of search_k to compare (0 is the default)')
+    neighbours.add_argument('--sample',
+                            type=int,
+                            default=200,
+                            help='Number of words to search')
+    neighbours.add_argument('--seed',
+                            type=int,
+                            default=1,
+                            help='Seed of the sample')
+    suite = subparsers.add_parser('suite',
+                                  help='Benchmark the hot paths on a synthetic corpus, without language model or embeddings')
+    suite.add_argument('--vocabulary',
+                       default='vocabularies/en',
+                       help='A list containing IV words, from which the small vocabulary is sampled')
+    suite.add_argument('--paths',
+                       default='clusters/en/paths',
+                       help='Brown cluster paths')
+    suite.add_argument('--vocabulary-size',
+                       type=int,
+                       default=20000,
+                       help='Number of words in the small vocabulary')
+    suite.add_argument('--tweets',
+                       type=int,
+                       default=5000,
+                       help='Number of synthetic tweets')
+    suite.add_argument('--seed',
+                       type=int,
+                       default=1,
+                       help='Seed of the vocabulary sample and the synthetic tweets')
+    suite.add_argument('--output',
+                       help='Save the results to this JSON file')
+    suite.add_argument('--baseline',
+                       help='Compare the results with those in this JSON file')
+    suite.add_argument('--tolerance',
+                       type=float,
+                       default=0.1,
+                       help='Relative loss of throughput which counts as a regression')
+    args = parser.parse_args()
+    if args.benchmark == 'candidates':
+        compare_candidates(args)
+    elif args.benchmark == 'neighbours':
+        compare_neighbours(args)
+    elif args.benchmark == 'suite':
+        if not run_suite(args):
+            sys.exit(1)
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
 import os
-from ctypes import cdll, c_char_p, c_void_p
+import threading
+from ctypes import (cdll, c_bool, c_char_p, c_void_p, c_size_t, c_uint32, c_uint64,
+                    c_float, c_double, POINTER, byref, string_at)
 
 
 _embeds_interface = cdll.LoadLibrary(os.path.join(os.path.dirname(__file__),
@@ -11,36 +13,188 @@ _embeds_interface.Embeds_loadTxt.argtypes = [c_void_p, c_char_p]
 _embeds_interface.Embeds_loadTxt.restype = c_void_p
 _embeds_interface.Embeds_loadBin.argtypes = [c_void_p, c_char_p]
 _embeds_interface.Embeds_loadBin.restype = c_void_p
+_embeds_interface.Embeds_loadW2V.argtypes = [c_void_p, c_char_p]
+_embeds_interface.Embeds_loadW2V.restype = c_void_p
+_embeds_interface.Embeds_fill.argtypes = [c_void_p, POINTER(c_uint32), c_size_t, c_size_t]
+_embeds_interface.Embeds_fill.restype = c_size_t
 _embeds_interface.Embeds_saveTxt.argtypes = [c_void_p, c_char_p]
 _embeds_interface.Embeds_saveTxt.restype = c_void_p
+_embeds_interface.Embeds_mapBin.argtypes = [c_void_p, c_char_p]
+_embeds_interface.Embeds_mapBin.restype = c_void_p
 _embeds_interface.Embeds_saveBin.argtypes = [c_void_p, c_char_p]
 _embeds_interface.Embeds_saveBin.restype = c_void_p
+_embeds_interface.Embeds_saveBinFloat.argtypes = [c_void_p, c_char_p]
+_embeds_interface.Embeds_saveBinFloat.restype = c_void_p
 _embeds_interface.Embeds_find.argtypes = [c_void_p, c_char_p]
 _embeds_interface.Embeds_find.restype = c_char_p
+_embeds_interface.Embeds_findMany.argtypes = [c_void_p, POINTER(c_char_p), c_size_t,
+                                              c_size_t, POINTER(c_uint32),
+                                              POINTER(c_double)]
+_embeds_interface.Embeds_findMany.restype = c_size_t
+_embeds_interface.Embeds_buildForest.argtypes = [c_void_p, c_size_t, c_size_t, c_uint64]
+_embeds_interface.Embeds_buildForest.restype = c_void_p
+_embeds_interface.Embeds_loadForest.argtypes = [c_void_p, c_char_p]
+_embeds_interface.Embeds_loadForest.restype = c_bool
+_embeds_interface.Embeds_saveForest.argtypes = [c_void_p, c_char_p]
+_embeds_interface.Embeds_saveForest.restype = c_void_p
+_embeds_interface.Embeds_setSearchK.argtypes = [c_void_p, c_size_t]
+_embeds_interface.Embeds_setSearchK.restype = c_void_p
+_embeds_interface.Embeds_search.argtypes = [c_void_p, c_char_p, POINTER(c_uint32),
+                                            POINTER(c_float), c_bool]
+_embeds_interface.Embeds_search.restype = c_bool
+_embeds_interface.Embeds_vocabData.argtypes = [c_void_p, POINTER(c_uint64)]
+_embeds_interface.Embeds_vocabData.restype = c_void_p
 
 
 class Embeds:
 
+    # Number of candidates stored per word in the cache
+    num_candidates = 40
+
     def __init__(self):
         self._embeddings = _embeds_interface.Embeds_create()
+        self._vocabulary = None
+        self._vocabulary_lock = threading.Lock()
 
     def loadTxt(self, path):
         _embeds_interface.Embeds_loadTxt(self._embeddings,
                                          c_char_p(path.encode('utf-8')))
 
-    def loadBin(self, path):
-        _embeds_interface.Embeds_loadBin(self._embeddings,
+    def loadBin(self, path, mmap=False):
+        """
+        Loads a cache. With mmap, the file is mapped read-only instead of
+        copied into memory, so processes share one copy of it and loading is
+        nearly instant. Neighbours missing from a mapped cache are not stored.
+        """
+        if mmap:
+            _embeds_interface.Embeds_mapBin(self._embeddings,
+                                            c_char_p(path.encode('utf-8')))
+        else:
+            _embeds_interface.Embeds_loadBin(self._embeddings,
+                                             c_char_p(path.encode('utf-8')))
+        self._vocabulary = None
+
+    def loadW2V(self, path):
+        """Loads a binary word2vec model, with an empty cache for all of its words."""
+        _embeds_interface.Embeds_loadW2V(self._embeddings,
                                          c_char_p(path.encode('utf-8')))
+        self._vocabulary = None
+
+    def fill(self, words=None, threads=0):
+        """
+        Computes the candidates of the given words (all words if None) which
+        are not cached yet, using the word2vec model loaded with loadW2V, on
+        the given number of threads (all cores if 0). Words which are not in
+        the model are skipped. Returns the number of filled words.
+        """
+        if words is None:
+            ids = (c_uint32 * 0)()
+        else:
+            word_ids = {word: word_id for word_id, word in enumerate(self.vocabulary)}
+            ids = [word_ids[word] for word in words if word_ids.get(word, 0)]
+            if not ids:
+                return 0
+            ids = (c_uint32 * len(ids))(*ids)
+        return _embeds_interface.Embeds_fill(self._embeddings, ids, len(ids), threads)
+
+    def buildIndex(self, trees=10, threads=0, seed=1):
+        """
+        Builds a random projection forest over the word2vec model loaded with
+        loadW2V, which is then used to search the candidates of words missing
+        from the cache approximately, instead of comparing them with all words.
+        """
+        _embeds_interface.Embeds_buildForest(self._embeddings, trees, threads, seed)
+
+    def loadIndex(self, path):
+        """Loads a forest saved by saveIndex, returns False if it does not match the word2vec model."""
+        return _embeds_interface.Embeds_loadForest(self._embeddings,
+                                                   c_char_p(path.encode('utf-8')))
+
+    def saveIndex(self, path):
+        _embeds_interface.Embeds_saveForest(self._embeddings,
+                                            c_char_p(path.encode('utf-8')))
+
+    def setSearchK(self, search_k):
+        """
+        Number of words compared with a word when searching the forest, which
+        trades recall for speed. 0 uses 512 words per tree.
+        """
+        _embeds_interface.Embeds_setSearchK(self._embeddings, search_k)
+
+    def search(self, word, exact=False):
+        """
+        Searches the (candidate, similarity) pairs of a word in the word2vec
+        model, without using or filling the cache. Uses the forest, if one is
+        loaded, unless exact is set. Returns None for unknown words.
+        """
+        ids = (c_uint32 * Embeds.num_candidates)()
+        similarities = (c_float * Embeds.num_candidates)()
+        if not _embeds_interface.Embeds_search(self._embeddings, word.encode('utf-8'),
+                                               ids, similarities, exact):
+            return None
+        vocabulary = self.vocabulary
+        return [(vocabulary[ids[index]], similarities[index])
+                for index in range(Embeds.num_candidates)]
 
     def saveTxt(self, path):
         _embeds_interface.Embeds_saveTxt(self._embeddings,
                                          c_char_p(path.encode('utf-8')))
 
-    def saveBin(self, path):
-        _embeds_interface.Embeds_saveBin(self._embeddings,
-                                         c_char_p(path.encode('utf-8')))
+    def saveBin(self, path, float32=False):
+        """Saves the cache, with float32 instead of float64 similarities if float32 is set."""
+        if float32:
+            _embeds_interface.Embeds_saveBinFloat(self._embeddings,
+                                                  c_char_p(path.encode('utf-8')))
+        else:
+            _embeds_interface.Embeds_saveBin(self._embeddings,
+                                             c_char_p(path.encode('utf-8')))
+
+    @property
+    def vocabulary(self):
+        """List of all words, indexed by the ids returned by find_ids."""
+        if self._vocabulary is None:
+            with self._vocabulary_lock:
+                if self._vocabulary is None:
+                    size = c_uint64()
+                    data = _embeds_interface.Embeds_vocabData(self._embeddings,
+                                                              byref(size))
+                    words = string_at(data, size.value).split(b'\0')
+                    # Id 0 means no candidate
+                    words[-1:] = []
+                    # word2vec cuts words at 50 bytes, which can split a character
+                    self._vocabulary = [''] + [word.decode('utf-8', errors='replace') for word in words]
+        return self._vocabulary
+
+    def find_ids(self, words, k=40, ids=None, similarities=None):
+        """
+        Looks up the k nearest neighbours of all words in one call. The ids
+        and similarities are written to caller-owned buffers of len(words) * k
+        values (for example uint32 and float64 NumPy arrays), which are
+        allocated if they are not given. Unknown words get id 0. Safe to call
+        from multiple threads.
+        """
+        k = min(k, Embeds.num_candidates)
+        size = len(words) * k
+        ids = (c_uint32 * size)() if ids is None else (c_uint32 * size).from_buffer(ids)
+        if similarities is None:
+            similarities = (c_double * size)()
+        else:
+            similarities = (c_double * size).from_buffer(similarities)
+        encoded = (c_char_p * len(words))(*(word.encode('utf-8') for word in words))
+        _embeds_interface.Embeds_findMany(self._embeddings, encoded, len(words), k,
+                                          ids, similarities)
+        return ids, similarities
+
+    def find_many(self, words, k=40):
+        """Returns a list of (candidate, similarity) pairs for every word."""
+        k = min(k, Embeds.num_candidates)
+        ids, similarities = self.find_ids(words, k)
+        vocabulary = self.vocabulary
+        return [[(vocabulary[ids[index]], similarities[index])
+                 for index in range(start, start + k)]
+                for start in range(0, len(words) * k, k)]
 
     def find(self, word):
-        str_array = _embeds_interface.Embeds_find(self._embeddings,
-                                                  c_char_p(word.encode('utf-8')))
-        return str_array.decode('utf-8').split(',')
+        ids, _ = self.find_ids([word])
+        vocabulary = self.vocabulary
+        return [vocabulary[candidate] for candidate in ids]
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Builds a cache of word embedding candidates ahead of time, so no candidates
+have to be searched in the raw word2vec model during generation.
+"""
+
+import os
+import sys
+import time
+import argparse
+
+from embeddings import Embeds
+
+
+def read_words(vocabularies, corpora):
+    """The words of the vocabulary files and the (lowercased) tokens of the corpora."""
+    words = set()
+    for path in vocabularies:
+        with open(path, 'r', encoding='utf-8') as f:
+            words.update(line.strip() for line in f)
+    for path in corpora:
+        with open(path, 'r', encoding='utf-8', newline='\n') as f:
+            for line in f:
+                words.update(token.lower() for token in line.split())
+    words.discard('')
+    return words
+
+
+def main(args):
+    embeddings = Embeds()
+    embeddings.loadW2V(args.w2v)
+    words = None
+    if args.vocabulary or args.corpus:
+        words = read_words(args.vocabulary, args.corpus)
+        print('Restricting the cache to {} words'.format(len(words)), file=sys.stderr)
+    start = time.perf_counter()
+    filled = embeddings.fill(words, args.threads)
+    print('Filled {} words in {:.1f}s'.format(filled, time.perf_counter() - start), file=sys.stderr)
+    embeddings.saveBin(args.output, float32=args.float32)
+    if args.index:
+        start = time.perf_counter()
+        embeddings.buildIndex(args.trees, args.threads, args.seed)
+        print('Built neighbour index in {:.1f}s'.format(time.perf_counter() - start), file=sys.stderr)
+        embeddings.saveIndex(args.output + '.ann')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute the word embedding candidates of a word2vec model',
+                                     prog='python3 -m embeddings.build')
+    parser.add_argument('--w2v', required=True,
+                        help='Binary word2vec model')
+    parser.add_argument('--output', required=True,
+                        help='Path of the cache (.cached.bin extension)')
+    parser.add_argument('--vocabulary', nargs='+', default=[],
+                        help='Only fill the candidates of the words in these vocabulary files')
+    parser.add_argument('--corpus', nargs='+', default=[],
+                        help='Only fill the candidates of the tokens in these files with tokenized tweets')
+    parser.add_argument('--threads', type=int, default=os.cpu_count(),
+                        help='Number of threads')
+    parser.add_argument('--float32', action='store_true',
+                        help='Store the similarities with single precision')
+    parser.add_argument('--index', action='store_true',
+                        help='Also build an index to search the neighbours of words missing from the cache, '
+                             'saved next to it (<output>.ann)')
+    parser.add_argument('--trees', type=int, default=10,
+                        help='Number of trees in the neighbour index; more trees give better neighbours')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Seed of the neighbour index')
+    main(parser.parse_args())
@@ -1,3 +1,3 @@
 #!/bin/bash
 
-g++ -fPIC source/*.cpp -shared -o embeds.so
+g++ -std=c++20 -O2 -pthread -fPIC source/*.cpp -shared -o embeds.so
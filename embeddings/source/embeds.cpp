@@ -1,7 +1,17 @@
 #include "embeds.h"
 
+#include <algorithm>
+#include <atomic>
+#include <cmath>
 #include <iostream>
 #include <map>
+#include <mutex>
+#include <thread>
+#include <string.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 #include <sstream>
 #include <string>
 #include <vector>
@@ -18,17 +28,30 @@ extern "C" {
     void Embeds_loadBin(Embeds* embeddings, char* filename) {
         embeddings->loadBin(filename);
     }
+    void Embeds_loadW2V(Embeds* embeddings, char* filename) {
+        embeddings->loadW2V(filename);
+    }
+    size_t Embeds_fill(Embeds* embeddings, const uint32_t* wordIds, size_t numIds,
+                       size_t numThreads) {
+        return embeddings->fill(wordIds, numIds, numThreads);
+    }
     void Embeds_saveTxt(Embeds* embeddings, char* filename) {
         embeddings->saveTxt(filename);
     }
+    void Embeds_mapBin(Embeds* embeddings, char* filename) {
+        embeddings->mapBin(filename);
+    }
     void Embeds_saveBin(Embeds* embeddings, char* filename) {
         embeddings->saveBin(filename);
     }
+    void Embeds_saveBinFloat(Embeds* embeddings, char* filename) {
+        embeddings->saveBin(filename, true);
+    }
     const char* Embeds_find(Embeds* embeddings, const char* word) {
         vector<string> candidates(40);
         vector<double> similarities(40);
         embeddings->find(word, &candidates[0], &similarities[0]);
-        static string results = "";
+        thread_local string results = "";
         results.clear();
         for (int i=0; i<candidates.size(); i++) {
             results.append(candidates[i]);
@@ -36,13 +59,61 @@ extern "C" {
         }
         return results.c_str();
     }
+    // Fills ids and vals (numWords * numCands each) with the candidates of
+    // every word, leaving zeros for unknown words. Returns the number of
+    // words which were found.
+    size_t Embeds_findMany(Embeds* embeddings, const char** words, size_t numWords,
+                           size_t numCands, uint32_t* ids, double* vals) {
+        size_t found = 0;
+        for (size_t idx = 0; idx != numWords; ++idx)
+            found += embeddings->findIds(words[idx], &ids[idx * numCands],
+                                         &vals[idx * numCands], numCands);
+        return found;
+    }
+    void Embeds_buildForest(Embeds* embeddings, size_t numTrees, size_t numThreads,
+                            uint64_t seed) {
+        embeddings->buildForest(numTrees, numThreads, seed);
+    }
+    bool Embeds_loadForest(Embeds* embeddings, char* filename) {
+        return embeddings->loadForest(filename);
+    }
+    void Embeds_saveForest(Embeds* embeddings, char* filename) {
+        embeddings->saveForest(filename);
+    }
+    void Embeds_setSearchK(Embeds* embeddings, size_t searchK) {
+        embeddings->setSearchK(searchK);
+    }
+    // Searches the candidates of a word in the w2v model, bypassing the cache
+    bool Embeds_search(Embeds* embeddings, const char* word, uint32_t* ids,
+                       float* vals, bool exact) {
+        return embeddings->search(word, ids, vals, exact);
+    }
+    const char* Embeds_vocabData(Embeds* embeddings, uint64_t* size) {
+        return embeddings->vocabData(size);
+    }
 }
 
+uint64_t const Embeds::s_floatMagic;
+
 Embeds::Embeds()
 //:
 {
 }
 
+Embeds::~Embeds()
+{
+    unmap();
+}
+
+void Embeds::unmap()
+{
+    if (!d_mapped)
+        return;
+    munmap(const_cast<char *>(d_mapped), d_mappedSize);
+    d_mapped = nullptr;
+    d_vocab.clear();
+}
+
 Embeds::Embeds(string const &vec, string const &cache, bool bin)
 :
     d_cachePath(cache),
@@ -99,35 +170,157 @@ void Embeds::loadTxt(string const &path)
 
 void Embeds::loadBin(string const &loc)
 {
+    unmap();
     cerr << "Loading: " << loc << '\n';
     ifstream ifs(loc, ios::binary);
     if (!ifs.good())
     {
         cerr << "No cache found, creating one at: " << loc << '\n';
-        d_numCands = 40;
-        d_numWords = d_rawW2V.getWords();
-        d_cands = vector<uint32_t>(d_numWords * d_numCands);
-        d_vals = vector<double>(d_numWords * d_numCands);
-        char *vocab = d_rawW2V.getVocab();
-        for (int beg = 0; beg != d_numWords; ++beg)
-            d_vocab.addWord(string(&vocab[beg * 50]));
-        d_vocab.optimize();
+        createCache();
         return;
     }
+    uint64_t magic = 0;
+    ifs.read(reinterpret_cast<char*>(&magic), sizeof(uint64_t));
+    d_floatVals = (magic == s_floatMagic);
+    if (!d_floatVals)
+        ifs.seekg(0);
     d_vocab.loadBin(&ifs);
-    ifs.read(reinterpret_cast<char*>(&d_numCands), sizeof(uint64_t));
-    ifs.read(reinterpret_cast<char*>(&d_numWords), sizeof(uint64_t));
+    uint64_t header[2];
+    ifs.read(reinterpret_cast<char*>(header), sizeof(header));
+    d_numWords = header[1];
     d_numCands = 40;
     
     d_cands = vector<uint32_t>((d_numWords +1) * d_numCands);
     ifs.read(reinterpret_cast<char*>(&d_cands[0]), sizeof(uint32_t) * (d_numWords + 1) * d_numCands);
     d_vals = vector<double>((d_numWords +1)* d_numCands);
-    ifs.read(reinterpret_cast<char*>(&d_vals[0]), sizeof(double) * (d_numWords + 1 )* d_numCands);
+    if (d_floatVals)
+    {
+        vector<float> vals(d_vals.size());
+        ifs.read(reinterpret_cast<char*>(&vals[0]), sizeof(float) * vals.size());
+        for (size_t idx = 0; idx != vals.size(); ++idx)
+            d_vals[idx] = vals[idx];
+        d_floatVals = false;
+    }
+    else
+        ifs.read(reinterpret_cast<char*>(&d_vals[0]), sizeof(double) * (d_numWords + 1 )* d_numCands);
     ifs.close();
 
 }
 
-void Embeds::saveBin(string const &path)
+// Empty cache for all words of d_rawW2V
+void Embeds::createCache()
+{
+    d_numCands = 40;
+    d_numWords = d_rawW2V.getWords();
+    // Ids start at 1
+    d_cands = vector<uint32_t>((d_numWords + 1) * d_numCands);
+    d_vals = vector<double>((d_numWords + 1) * d_numCands);
+    char *vocab = d_rawW2V.getVocab();
+    for (int beg = 0; beg != d_numWords; ++beg)
+        d_vocab.addWord(string(&vocab[beg * 50]));
+    d_vocab.optimize();
+}
+
+// Loads a binary word2vec model, with an empty cache for all of its words
+void Embeds::loadW2V(string const &loc)
+{
+    unmap();
+    if (d_rawW2V.load(loc) != 0)
+    {
+        cerr << "Could not read w2v model: " << loc << '\n';
+        exit(1);
+    }
+    d_vocab.clear();
+    createCache();
+}
+
+void Embeds::mapBin(string const &loc)
+{
+    unmap();
+    cerr << "Mapping: " << loc << '\n';
+    int fd = open(loc.c_str(), O_RDONLY);
+    struct stat info;
+    if (fd < 0 || fstat(fd, &info) != 0)
+    {
+        cerr << "Could not read cache: " << loc << '\n';
+        exit(1);
+    }
+    void *data = mmap(nullptr, info.st_size, PROT_READ, MAP_SHARED, fd, 0);
+    close(fd);
+    if (data == MAP_FAILED)
+    {
+        cerr << "Could not map cache: " << loc << '\n';
+        exit(1);
+    }
+    d_mapped = static_cast<char const *>(data);
+    d_mappedSize = info.st_size;
+
+    char const *pos = d_mapped;
+    uint64_t magic;
+    memcpy(&magic, pos, sizeof(uint64_t));
+    d_floatVals = (magic == s_floatMagic);
+    if (d_floatVals)
+        pos += sizeof(uint64_t);
+    pos += d_vocab.mapBin(pos);
+    uint64_t header[2];
+    memcpy(header, pos, sizeof(header));
+    pos += sizeof(header);
+    d_numWords = header[1];
+    d_numCands = 40;
+    d_mappedCands = pos;
+    pos += sizeof(uint32_t) * (d_numWords + 1) * d_numCands;
+    d_mappedVals = pos;
+    pos += (d_floatVals ? sizeof(float) : sizeof(double)) * (d_numWords + 1) * d_numCands;
+    if (pos > d_mapped + d_mappedSize)
+    {
+        cerr << "Cache is truncated: " << loc << '\n';
+        exit(1);
+    }
+    d_cands.clear();
+    d_vals.clear();
+}
+
+uint32_t Embeds::cand(size_t idx) const
+{
+    if (!d_mapped)
+        return d_cands[idx];
+    uint32_t ret;
+    memcpy(&ret, d_mappedCands + idx * sizeof(uint32_t), sizeof(uint32_t));
+    return ret;
+}
+
+// The first candidate of a word is stored last, with release ordering, and
+// read with acquire ordering: a thread which sees it set also sees the other
+// candidates and similarities of the word
+uint32_t Embeds::firstCand(size_t wordId) const
+{
+    if (d_mapped)
+        return cand(wordId * d_numCands);
+    return atomic_ref<uint32_t>(const_cast<uint32_t &>(d_cands[wordId * d_numCands]))
+        .load(memory_order_acquire);
+}
+
+void Embeds::publish(size_t wordId, uint32_t firstId)
+{
+    atomic_ref<uint32_t>(d_cands[wordId * d_numCands]).store(firstId, memory_order_release);
+}
+
+double Embeds::val(size_t idx) const
+{
+    if (!d_mapped)
+        return d_vals[idx];
+    if (d_floatVals)
+    {
+        float ret;
+        memcpy(&ret, d_mappedVals + idx * sizeof(float), sizeof(float));
+        return ret;
+    }
+    double ret;
+    memcpy(&ret, d_mappedVals + idx * sizeof(double), sizeof(double));
+    return ret;
+}
+
+void Embeds::saveBin(string const &path, bool floatVals)
 {
     cerr << "Saving: " << path << '\n';
     ofstream ofs(path);
@@ -136,15 +329,34 @@ void Embeds::saveBin(string const &path)
         cerr << "Could not write w2v model: " << path << '\n';
         exit(1);
     }
+    if (floatVals)
+        ofs.write(reinterpret_cast<char const*>(&s_floatMagic), sizeof(uint64_t));
     d_vocab.saveBin(&ofs);
-    ofs.write(reinterpret_cast<char*>(&d_numCands), sizeof(uint64_t));
-    ofs.write(reinterpret_cast<char*>(&d_numWords), sizeof(uint64_t));
+    uint64_t header[2] = {uint64_t(d_numCands), uint64_t(d_numWords)};
+    ofs.write(reinterpret_cast<char*>(header), sizeof(header));
 
-    ofs.write(reinterpret_cast<char*>(&d_cands[0]), sizeof(uint32_t) * d_numCands * (d_numWords + 1));
-    ofs.write(reinterpret_cast<char*>(&d_vals[0]), sizeof(double) * d_numCands * (d_numWords + 1));
+    size_t numVals = size_t(d_numCands) * (d_numWords + 1);
+    if (d_mapped)
+        ofs.write(d_mappedCands, sizeof(uint32_t) * numVals);
+    else
+        ofs.write(reinterpret_cast<char*>(&d_cands[0]), sizeof(uint32_t) * numVals);
+    if (floatVals)
+    {
+        vector<float> vals(numVals);
+        for (size_t idx = 0; idx != numVals; ++idx)
+            vals[idx] = val(idx);
+        ofs.write(reinterpret_cast<char*>(&vals[0]), sizeof(float) * numVals);
+    }
+    else if (d_mapped)
+    {
+        vector<double> vals(numVals);
+        for (size_t idx = 0; idx != numVals; ++idx)
+            vals[idx] = val(idx);
+        ofs.write(reinterpret_cast<char*>(&vals[0]), sizeof(double) * numVals);
+    }
+    else
+        ofs.write(reinterpret_cast<char*>(&d_vals[0]), sizeof(double) * numVals);
     ofs.close();
-
-    
 }
 
 void Embeds::saveTxt(string const &path)
@@ -164,8 +376,8 @@ void Embeds::saveTxt(string const &path)
     {
         ofs << wordId << '\t';
         for (int candIdx = 0; candIdx != d_numCands; ++candIdx)
-            ofs << d_cands[wordId * d_numCands + candIdx] << '\t' 
-                << d_vals[wordId * d_numCands + candIdx] << '\t';
+            ofs << cand(wordId * d_numCands + candIdx) << '\t' 
+                << val(wordId * d_numCands + candIdx) << '\t';
         ofs << '\n';
     }
     ofs.close();
@@ -173,36 +385,281 @@ void Embeds::saveTxt(string const &path)
 
 bool Embeds::find(char const *word, string *retCands, double *retVals)
 {
+    vector<uint32_t> ids(40);
+    if (!findIds(word, &ids[0], retVals, 40))
+        return false;
+    for (size_t a = 0; a != 40; ++a)
+        retCands[a] = (ids[a] == 0) ? string() : string(d_vocab.getWord(ids[a]));
+    return true;
+}
+
+bool Embeds::findIds(char const *word, uint32_t *retIds, double *retVals, size_t numCands)
+{
+    if (numCands > 40)
+        numCands = 40;
+    for (size_t a = 0; a != numCands; ++a)
+    {
+        retIds[a] = 0;
+        retVals[a] = 0.0;
+    }
     uint32_t wordId = d_vocab.getId(word);
     if(wordId == 0)
         return false;
 
-    //cout << wordId <<  '\n';
-    if (d_cands[wordId * d_numCands] == 0)
+    if (firstCand(wordId) == 0)
     {
-        //cerr << "word " << word << " not found!\n";
-        vector<string> cands(40);
+        vector<uint32_t> ids(40);
         vector<float> vals(40);
-        bool have = d_rawW2V.find(word, &cands[0], &vals[0]);
+        bool have = search(word, &ids[0], &vals[0], false);
         if (!have) //This should never happen?
             return false;
+        if (d_mapped)
+        {
+            // The mapped cache is read-only, so the result is not stored
+            for (size_t a = 0; a != numCands; ++a)
+            {
+                retIds[a] = ids[a];
+                retVals[a] = vals[a];
+            }
+            return true;
+        }
+        lock_guard<mutex> lock(d_fillMutex);
+        if (firstCand(wordId) == 0)
+        {
+            d_vals[wordId * d_numCands] = double(vals[0]);
+            for (size_t a = 1; a != 40; ++a)
+            {
+                d_vals[wordId * d_numCands + a] = double(vals[a]);
+                d_cands[wordId * d_numCands + a] = ids[a];
+            }
+            publish(wordId, ids[0]);
+            d_cachedSomething = true;
+        }
+    }
+    for (size_t a = 0; a != numCands; ++a)
+    {
+        retIds[a] = cand(wordId * d_numCands + a);
+        retVals[a] = val(wordId * d_numCands + a);
+    }
+    return true;
+}
+
+// Searches the 40 candidates of a word in d_rawW2V, with the forest if one
+// is loaded, unless exact is set
+bool Embeds::search(char const *word, uint32_t *retIds, float *retVals, bool exact)
+{
+    if (exact || d_forest.numTrees() == 0)
+    {
+        vector<string> cands(40);
+        // d_rawW2V uses member buffers, so only one thread can search at a time
+        lock_guard<mutex> lock(d_fillMutex);
+        if (!d_rawW2V.find(word, &cands[0], retVals))
+            return false;
         for (size_t a = 0; a != 40; ++a)
+            retIds[a] = d_vocab.getId(cands[a]);
+        return true;
+    }
+    long long row = d_rawW2V.getRow(word);
+    if (row < 0)
+        return false;
+    size_t const size = d_rawW2V.getSize();
+    float const *vectors = d_rawW2V.getVectors();
+    // Normalized again, as d_rawW2V.find does
+    vector<float> query(vectors + row * size, vectors + (row + 1) * size);
+    float len = 0;
+    for (size_t a = 0; a != size; ++a)
+        len += query[a] * query[a];
+    len = sqrt(len);
+    for (size_t a = 0; a != size; ++a)
+        query[a] /= len;
+    vector<uint32_t> rows(40);
+    d_forest.find(vectors, &query[0], row, 40, &rows[0], retVals);
+    char const *vocab = d_rawW2V.getVocab();
+    for (size_t a = 0; a != 40; ++a)
+        retIds[a] = d_vocab.getId(&vocab[rows[a] * d_rawW2V.getMaxW()]);
+    return true;
+}
+
+void Embeds::buildForest(size_t numTrees, size_t numThreads, uint64_t seed)
+{
+    d_forest.build(d_rawW2V.getVectors(), d_rawW2V.getWords(), d_rawW2V.getSize(),
+                   numTrees, numThreads, seed);
+}
+
+bool Embeds::loadForest(string const &path)
+{
+    cerr << "Loading: " << path << '\n';
+    return d_forest.load(path, d_rawW2V.getWords(), d_rawW2V.getSize());
+}
+
+void Embeds::saveForest(string const &path)
+{
+    d_forest.save(path);
+}
+
+void Embeds::setSearchK(size_t searchK)
+{
+    d_forest.setSearchK(searchK);
+}
+
+char const *Embeds::vocabData(uint64_t *size)
+{
+    return d_vocab.data(size);
+}
+
+// Fills the cache for the given word ids (all words if numIds is 0) which do
+// not have candidates yet, comparing blocks of words with blocks of the raw
+// model on numThreads threads. The candidates are the same as the ones found
+// one word at a time by d_rawW2V.find. Returns the number of filled words.
+size_t Embeds::fill(uint32_t const *wordIds, size_t numIds, size_t numThreads)
+{
+    if (d_mapped)
+    {
+        cerr << "Cannot fill a mapped cache\n";
+        return 0;
+    }
+    size_t const words = d_rawW2V.getWords();
+    size_t const size = d_rawW2V.getSize();
+    char const *vocab = d_rawW2V.getVocab();
+    float const *vectors = d_rawW2V.getVectors();
+
+    // Raw model row of every id and the other way around
+    vector<long long> rowOf(size_t(d_numWords) + 1, -1);
+    vector<uint32_t> idOf(words);
+    for (size_t row = 0; row != words; ++row)
+    {
+        idOf[row] = d_vocab.getId(&vocab[row * d_rawW2V.getMaxW()]);
+        if (rowOf[idOf[row]] == -1)
+            rowOf[idOf[row]] = row;
+    }
+
+    vector<uint32_t> all;
+    if (numIds == 0)
+    {
+        for (uint32_t id = 1; id != d_vocab.size() + 1; ++id)
+            all.push_back(id);
+        wordIds = all.data();
+        numIds = all.size();
+    }
+    // Ids of the words to fill, paired with their raw model row
+    vector<long long> rows;
+    for (size_t idx = 0; idx != numIds; ++idx)
+    {
+        uint32_t id = wordIds[idx];
+        if (id == 0 || id > uint32_t(d_numWords) || rowOf[id] < 0
+                || firstCand(id) != 0)
+            continue;
+        rows.push_back(id);
+        rows.push_back(rowOf[id]);
+    }
+    size_t const numRows = rows.size() / 2;
+
+    // Normalized again, as d_rawW2V.find does
+    vector<float> queries(numRows * size);
+    for (size_t idx = 0; idx != numRows; ++idx)
+    {
+        float *query = &queries[idx * size];
+        float len = 0;
+        for (size_t a = 0; a != size; ++a)
         {
-            d_cands[wordId * d_numCands + a] = d_vocab.getId(cands[a]);
-            retCands[a] = cands[a];
-            d_vals[wordId * d_numCands + a] = double(vals[a]);
-            retVals[a] = vals[a];
+            query[a] = vectors[a + rows[2 * idx + 1] * size];
+            len += query[a] * query[a];
         }
+        len = sqrt(len);
+        for (size_t a = 0; a != size; ++a)
+            query[a] /= len;
+    }
+
+    size_t const blockRows = 32;
+    atomic<size_t> next(0);
+    auto work = [&]()
+    {
+        for (size_t beg = next.fetch_add(blockRows); beg < numRows;
+                beg = next.fetch_add(blockRows))
+            fillBlock(rows, queries.data(), beg, min(beg + blockRows, numRows), idOf);
+    };
+    if (numThreads == 0)
+        numThreads = max(1u, thread::hardware_concurrency());
+    vector<thread> threads;
+    for (size_t idx = 1; idx < numThreads; ++idx)
+        threads.emplace_back(work);
+    work();
+    for (thread &worker: threads)
+        worker.join();
+    if (numRows)
         d_cachedSomething = true;
+    return numRows;
+}
+
+// Finds the candidates of queries beg to end, comparing them with blocks of
+// raw model rows small enough to stay in the cache
+void Embeds::fillBlock(vector<long long> const &rows, float const *queries,
+                       size_t beg, size_t end, vector<uint32_t> const &idOf)
+{
+    size_t const words = d_rawW2V.getWords();
+    size_t const size = d_rawW2V.getSize();
+    float const *vectors = d_rawW2V.getVectors();
+    size_t const numCands = d_numCands;
+    size_t const blockCols = max(size_t(1), (size_t(1) << 18) / (sizeof(float) * size));
+
+    // Best rows so far, ordered by similarity and then by row
+    vector<float> bestd((end - beg) * numCands, -1);
+    vector<long long> bestw((end - beg) * numCands, 0);
+
+    for (size_t colBeg = 0; colBeg < words; colBeg += blockCols)
+    {
+        size_t colEnd = min(colBeg + blockCols, words);
+        for (size_t idx = beg; idx != end; ++idx)
+        {
+            float const *query = &queries[idx * size];
+            float *dists = &bestd[(idx - beg) * numCands];
+            long long *cands = &bestw[(idx - beg) * numCands];
+            long long const self = rows[2 * idx + 1];
+            // Four rows at a time, each summed in the same order as d_rawW2V.find
+            for (size_t col = colBeg; col < colEnd; col += 4)
+            {
+                size_t const num = min(size_t(4), colEnd - col);
+                float dist[4] = {0, 0, 0, 0};
+                float const *vec = &vectors[col * size];
+                if (num == 4)
+                    for (size_t a = 0; a != size; ++a)
+                    {
+                        dist[0] += query[a] * vec[a];
+                        dist[1] += query[a] * vec[a + size];
+                        dist[2] += query[a] * vec[a + 2 * size];
+                        dist[3] += query[a] * vec[a + 3 * size];
+                    }
+                else
+                    for (size_t row = 0; row != num; ++row)
+                        for (size_t a = 0; a != size; ++a)
+                            dist[row] += query[a] * vec[a + row * size];
+                for (size_t row = 0; row != num; ++row)
+                {
+                    if (col + row == size_t(self) || !(dist[row] > dists[numCands - 1]))
+                        continue;
+                    size_t pos = numCands - 1;
+                    while (pos != 0 && dist[row] > dists[pos - 1])
+                    {
+                        dists[pos] = dists[pos - 1];
+                        cands[pos] = cands[pos - 1];
+                        --pos;
+                    }
+                    dists[pos] = dist[row];
+                    cands[pos] = col + row;
+                }
+            }
+        }
     }
-    else
+
+    for (size_t idx = beg; idx != end; ++idx)
     {
-        //cout << "Found " << word << '\n';
-        for (size_t a = 0; a != 40; ++a)
+        size_t const offset = size_t(rows[2 * idx]) * numCands;
+        for (size_t a = numCands; a-- != 1; )
         {
-            retCands[a] = d_vocab.getWord(d_cands[wordId * d_numCands + a]);
-            retVals[a] = d_vals[wordId * d_numCands + a];
+            d_cands[offset + a] = idOf[bestw[(idx - beg) * numCands + a]];
+            d_vals[offset + a] = double(bestd[(idx - beg) * numCands + a]);
         }
+        d_vals[offset] = double(bestd[(idx - beg) * numCands]);
+        publish(rows[2 * idx], idOf[bestw[(idx - beg) * numCands]]);
     }
-    return true;
 }
@@ -2,8 +2,10 @@
 #define INCLUDED_EMBEDS_
 
 #include <string>
+#include <mutex>
 #include <stdint.h>
 #include "./w2v.h"
+#include "./forest.h"
 
 class Embeds
 {
@@ -12,25 +14,56 @@ class Embeds
     int d_numWords;
     int d_numCands;
     bool d_cachedSomething = false;
+    std::mutex d_fillMutex; // Guards filling the cache from d_rawW2V
+    Forest d_forest; // Optional, to search d_rawW2V approximately
 
     Vocab d_vocab;
     std::vector<uint32_t> d_cands;
     std::vector<double> d_vals;
 
+    // Set by mapBin, when the cache is read from a read-only mapping instead
+    char const *d_mapped = nullptr;
+    size_t d_mappedSize = 0;
+    char const *d_mappedCands = nullptr;
+    char const *d_mappedVals = nullptr;
+    bool d_floatVals = false;
+
+    // Written before the vocabulary in caches with float similarities
+    static uint64_t const s_floatMagic = 0x0100323346424d45; // "EMBF32\0\1"
+
     public:
         Embeds();
         Embeds(std::string const &vec, std::string const &cache = "", bool bin = true);
+        ~Embeds();
         
         void loadBin(std::string const &path);
+        void mapBin(std::string const &path);
         void loadTxt(std::string const &path);
-        void saveBin(std::string const &path);
+        void loadW2V(std::string const &path);
+        void saveBin(std::string const &path, bool floatVals = false);
         void saveTxt(std::string const &path);
         void combine(int argc, char* argv[]);
+        size_t fill(uint32_t const *wordIds, size_t numIds, size_t numThreads);
+        void buildForest(size_t numTrees, size_t numThreads, uint64_t seed);
+        bool loadForest(std::string const &path);
+        void saveForest(std::string const &path);
+        void setSearchK(size_t searchK);
 
         bool find(char const *word, std::string *retCands, double *retVals);
+        bool findIds(char const *word, uint32_t *retIds, double *retVals, size_t numCands);
+        bool search(char const *word, uint32_t *retIds, float *retVals, bool exact);
+        char const *vocabData(uint64_t *size);
         double getDistance(std::string const &word1, std::string const &word2);
 
     private:
+        void unmap();
+        void createCache();
+        void fillBlock(std::vector<long long> const &rows, float const *queries,
+                       size_t beg, size_t end, std::vector<uint32_t> const &idOf);
+        uint32_t cand(size_t idx) const;
+        uint32_t firstCand(size_t wordId) const;
+        void publish(size_t wordId, uint32_t firstId);
+        double val(size_t idx) const;
 };
         
 #endif
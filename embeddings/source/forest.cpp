@@ -0,0 +1,263 @@
+#include "forest.h"
+
+#include <algorithm>
+#include <atomic>
+#include <cstdlib>
+#include <fstream>
+#include <iostream>
+#include <limits>
+#include <queue>
+#include <random>
+#include <thread>
+#include <tuple>
+
+using namespace std;
+
+uint64_t const Forest::s_magic;
+size_t const Forest::s_leafSize;
+
+void Forest::clear()
+{
+    d_trees.clear();
+    d_words = 0;
+    d_size = 0;
+}
+
+size_t Forest::searchK() const
+{
+    if (d_searchK)
+        return d_searchK;
+    return d_trees.size() * s_leafSize * 8;
+}
+
+void Forest::build(float const *vectors, size_t words, size_t size,
+                   size_t numTrees, size_t numThreads, uint64_t seed)
+{
+    d_words = words;
+    d_size = size;
+    d_trees = vector<Tree>(numTrees);
+    atomic<size_t> next(0);
+    auto work = [&]()
+    {
+        for (size_t idx = next++; idx < numTrees; idx = next++)
+            buildTree(&d_trees[idx], vectors, seed + idx);
+    };
+    if (numThreads == 0)
+        numThreads = max(1u, thread::hardware_concurrency());
+    vector<thread> threads;
+    for (size_t idx = 1; idx < min(numThreads, numTrees); ++idx)
+        threads.emplace_back(work);
+    work();
+    for (thread &worker: threads)
+        worker.join();
+}
+
+// Splits the rows at hyperplanes halfway between two random rows, until at
+// most s_leafSize rows are left
+void Forest::buildTree(Tree *tree, float const *vectors, uint64_t seed) const
+{
+    mt19937_64 random(seed);
+    vector<uint32_t> rows(d_words);
+    for (size_t row = 0; row != d_words; ++row)
+        rows[row] = row;
+
+    // Where to store the node (max for the root), and its rows
+    vector<tuple<size_t, size_t, size_t>> todo;
+    todo.emplace_back(numeric_limits<size_t>::max(), 0, d_words);
+    vector<float> normal(d_size);
+    while (!todo.empty())
+    {
+        size_t slot, beg, end;
+        tie(slot, beg, end) = todo.back();
+        todo.pop_back();
+
+        int64_t node;
+        if (end - beg <= s_leafSize)
+        {
+            if (tree->d_leafStarts.empty())
+                tree->d_leafStarts.push_back(0);
+            node = -int64_t(tree->d_leafStarts.size());
+            tree->d_leafRows.insert(tree->d_leafRows.end(), &rows[beg], &rows[end]);
+            tree->d_leafStarts.push_back(tree->d_leafRows.size());
+        }
+        else
+        {
+            node = tree->d_children.size() / 2;
+            size_t split = beg;
+            float offset = 0;
+            for (size_t attempt = 0; attempt != 5 && (split == beg || split == end); ++attempt)
+            {
+                uniform_int_distribution<size_t> pick(beg, end - 1);
+                float const *first = &vectors[rows[pick(random)] * d_size];
+                float const *second = &vectors[rows[pick(random)] * d_size];
+                offset = 0;
+                for (size_t a = 0; a != d_size; ++a)
+                {
+                    normal[a] = first[a] - second[a];
+                    offset -= normal[a] * (first[a] + second[a]) / 2;
+                }
+                auto left = [&](uint32_t row)
+                {
+                    float margin = offset;
+                    for (size_t a = 0; a != d_size; ++a)
+                        margin += normal[a] * vectors[row * d_size + a];
+                    return margin <= 0;
+                };
+                split = partition(&rows[beg], &rows[end], left) - &rows[0];
+            }
+            if (split == beg || split == end)
+            {
+                // Identical vectors, any split will do
+                fill(normal.begin(), normal.end(), 0);
+                offset = 0;
+                split = beg + (end - beg) / 2;
+            }
+            tree->d_normals.insert(tree->d_normals.end(), normal.begin(), normal.end());
+            tree->d_offsets.push_back(offset);
+            tree->d_children.push_back(0);
+            tree->d_children.push_back(0);
+            todo.emplace_back(2 * node, beg, split);
+            todo.emplace_back(2 * node + 1, split, end);
+        }
+        if (slot == numeric_limits<size_t>::max())
+            tree->d_root = node;
+        else
+            tree->d_children[slot] = node;
+    }
+}
+
+size_t Forest::find(float const *vectors, float const *query, int64_t skip,
+                    size_t numCands, uint32_t *retRows, float *retDists) const
+{
+    size_t const searchK = this->searchK();
+    // Visit the nodes closest to the query first, in all trees at once
+    priority_queue<tuple<float, size_t, int64_t>> queue;
+    for (size_t idx = 0; idx != d_trees.size(); ++idx)
+        queue.emplace(numeric_limits<float>::infinity(), idx,
+                      d_trees[idx].d_root);
+    vector<uint32_t> rows;
+    while (!queue.empty() && rows.size() < searchK)
+    {
+        float priority;
+        size_t treeIdx;
+        int64_t node;
+        tie(priority, treeIdx, node) = queue.top();
+        queue.pop();
+        Tree const &tree = d_trees[treeIdx];
+        if (node < 0)
+        {
+            size_t leaf = -1 - node;
+            rows.insert(rows.end(), &tree.d_leafRows[tree.d_leafStarts[leaf]],
+                        &tree.d_leafRows[0] + tree.d_leafStarts[leaf + 1]);
+            continue;
+        }
+        float margin = tree.d_offsets[node];
+        float const *normal = &tree.d_normals[node * d_size];
+        for (size_t a = 0; a != d_size; ++a)
+            margin += normal[a] * query[a];
+        queue.emplace(min(priority, -margin), treeIdx, tree.d_children[2 * node]);
+        queue.emplace(min(priority, margin), treeIdx, tree.d_children[2 * node + 1]);
+    }
+    sort(rows.begin(), rows.end());
+    rows.erase(unique(rows.begin(), rows.end()), rows.end());
+
+    // Exact similarities of the rows found, ordered like w2v::find does
+    for (size_t a = 0; a != numCands; ++a)
+    {
+        retRows[a] = 0;
+        retDists[a] = -1;
+    }
+    for (uint32_t row: rows)
+    {
+        if (int64_t(row) == skip)
+            continue;
+        float dist = 0;
+        for (size_t a = 0; a != d_size; ++a)
+            dist += query[a] * vectors[row * d_size + a];
+        if (!(dist > retDists[numCands - 1]))
+            continue;
+        size_t pos = numCands - 1;
+        while (pos != 0 && dist > retDists[pos - 1])
+        {
+            retDists[pos] = retDists[pos - 1];
+            retRows[pos] = retRows[pos - 1];
+            --pos;
+        }
+        retDists[pos] = dist;
+        retRows[pos] = row;
+    }
+    return rows.size();
+}
+
+bool Forest::load(string const &path, size_t words, size_t size)
+{
+    clear();
+    ifstream ifs(path, ios::binary);
+    uint64_t header[4] = {0, 0, 0, 0};
+    ifs.read(reinterpret_cast<char*>(header), sizeof(header));
+    if (!ifs.good() || header[0] != s_magic)
+    {
+        cerr << "Could not read neighbour index: " << path << '\n';
+        return false;
+    }
+    if (header[1] != words || header[2] != size)
+    {
+        cerr << "Neighbour index does not match the w2v model: " << path << '\n';
+        return false;
+    }
+    d_words = words;
+    d_size = size;
+    d_trees = vector<Tree>(header[3]);
+    auto read = [&](auto *values)
+    {
+        uint64_t num;
+        ifs.read(reinterpret_cast<char*>(&num), sizeof(uint64_t));
+        values->resize(num);
+        ifs.read(reinterpret_cast<char*>(values->data()), num * sizeof((*values)[0]));
+    };
+    for (Tree &tree: d_trees)
+    {
+        ifs.read(reinterpret_cast<char*>(&tree.d_root), sizeof(int64_t));
+        read(&tree.d_children);
+        read(&tree.d_normals);
+        read(&tree.d_offsets);
+        read(&tree.d_leafStarts);
+        read(&tree.d_leafRows);
+    }
+    if (!ifs.good())
+    {
+        cerr << "Neighbour index is truncated: " << path << '\n';
+        clear();
+        return false;
+    }
+    return true;
+}
+
+void Forest::save(string const &path)
+{
+    cerr << "Saving: " << path << '\n';
+    ofstream ofs(path, ios::binary);
+    if (!ofs.good())
+    {
+        cerr << "Could not write neighbour index: " << path << '\n';
+        exit(1);
+    }
+    uint64_t header[4] = {s_magic, d_words, d_size, d_trees.size()};
+    ofs.write(reinterpret_cast<char*>(header), sizeof(header));
+    auto write = [&](auto const &values)
+    {
+        uint64_t num = values.size();
+        ofs.write(reinterpret_cast<char*>(&num), sizeof(uint64_t));
+        ofs.write(reinterpret_cast<char const*>(values.data()), num * sizeof(values[0]));
+    };
+    for (Tree const &tree: d_trees)
+    {
+        ofs.write(reinterpret_cast<char const*>(&tree.d_root), sizeof(int64_t));
+        write(tree.d_children);
+        write(tree.d_normals);
+        write(tree.d_offsets);
+        write(tree.d_leafStarts);
+        write(tree.d_leafRows);
+    }
+    ofs.close();
+}
@@ -0,0 +1,51 @@
+#ifndef INCLUDED_FOREST_
+#define INCLUDED_FOREST_
+
+#include <string>
+#include <vector>
+#include <stdint.h>
+
+// Random projection forest over normalized word vectors, to find approximate
+// nearest neighbours without comparing a word with all other words
+class Forest
+{
+    struct Tree
+    {
+        // Root and children of the nodes. Negative nodes are leaves:
+        // -1 - the index in d_leafStarts.
+        int64_t d_root = 0;
+        std::vector<int64_t> d_children; // two per node
+        std::vector<float> d_normals; // size values per node
+        std::vector<float> d_offsets;
+        std::vector<uint64_t> d_leafStarts; // one more than there are leaves
+        std::vector<uint32_t> d_leafRows;
+    };
+
+    std::vector<Tree> d_trees;
+    uint64_t d_words = 0;
+    uint64_t d_size = 0;
+    size_t d_searchK = 0;
+
+    static uint64_t const s_magic = 0x0100534552464d45; // "EMFRES\0\1"
+    static size_t const s_leafSize = 64;
+
+    public:
+        void build(float const *vectors, size_t words, size_t size,
+                   size_t numTrees, size_t numThreads, uint64_t seed);
+        bool load(std::string const &path, size_t words, size_t size);
+        void save(std::string const &path);
+        void clear();
+
+        size_t numTrees() const {return d_trees.size();};
+        void setSearchK(size_t searchK){d_searchK = searchK;};
+        size_t searchK() const;
+
+        // Best numCands rows for the query, except row skip
+        size_t find(float const *vectors, float const *query, int64_t skip,
+                    size_t numCands, uint32_t *retRows, float *retDists) const;
+
+    private:
+        void buildTree(Tree *tree, float const *vectors, uint64_t seed) const;
+};
+
+#endif
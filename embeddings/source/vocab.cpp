@@ -29,6 +29,7 @@ Vocab::Vocab(ifstream *ifs)
 
 void Vocab::clear()
 {
+    d_mapped = nullptr;
     std::set<std::string> tmp;
     d_collect.swap(tmp);
 
@@ -70,25 +71,23 @@ void Vocab::save(string const &path)
 
 void Vocab::save(ofstream *ofs)
 {
-    if (d_idxs.size() <= 1)
+    if (numIdxs() <= 1)
         return;
-    for (uint32_t wordIdx = 1; wordIdx != d_idxs.size(); ++wordIdx)
+    for (uint32_t wordIdx = 1; wordIdx != numIdxs(); ++wordIdx)
     {
-        (*ofs) << &d_vocab[d_idxs[wordIdx]] << '\n';
+        (*ofs) << wordAt(wordIdx) << '\n';
     }
 }
 
 uint32_t Vocab::getId(string const &target)
 {
-    return getId(0, d_idxs.size()-1, &target[0]);
+    return getId(0, numIdxs()-1, &target[0]);
 }
 
 uint32_t Vocab::getId(uint32_t beg, uint32_t end, char const *searchWord)
 {
     uint32_t split = (end + beg) / 2;
-    uint32_t begIdx = d_idxs[split];
-
-    int comp = strcmp(searchWord, &d_vocab[begIdx]);
+    int comp = strcmp(searchWord, wordAt(split));
     
     //TODO this should be possible with less ifs
     if (beg == split && end == beg + 1)
@@ -113,19 +112,19 @@ void Vocab::addWord(string const &word)
 uint32_t Vocab::findBeg(uint32_t beg, uint32_t end, char const *searchWord)
 {
     uint32_t split = (end + beg) / 2;
-    uint32_t lenSplit = strlen(&d_vocab[d_idxs[split]]);
+    uint32_t lenSplit = strlen(wordAt(split));
     uint32_t lenSearchword = strlen(searchWord);
 
     if (lenSplit > lenSearchword)
         lenSplit = lenSearchword;
 
-    int comp = strncmp(searchWord, &d_vocab[d_idxs[split]], lenSplit);
-    int comp2 = strncmp(searchWord, &d_vocab[d_idxs[split]], lenSearchword);
+    int comp = strncmp(searchWord, wordAt(split), lenSplit);
+    int comp2 = strncmp(searchWord, wordAt(split), lenSearchword);
     if (comp2 == 0)
         return split;
     if (lenSplit < lenSearchword)
     {
-        comp = strcmp(searchWord, &d_vocab[d_idxs[split]]);
+        comp = strcmp(searchWord, wordAt(split));
     }
     if (beg == end || beg == split)
         return 0;
@@ -138,7 +137,7 @@ uint32_t Vocab::findBeg(uint32_t beg, uint32_t end, char const *searchWord)
 
 char *Vocab::getWord(uint32_t id)
 {
-    return &d_vocab[d_idxs[id]];
+    return const_cast<char *>(wordAt(id));
 }
 
 bool Vocab::contains(string const &target)
@@ -148,17 +147,17 @@ bool Vocab::contains(string const &target)
 
 pair<uint32_t, uint32_t> Vocab::getRange(char const *word)
 {
-    uint32_t beg = findBeg(0, d_idxs.size()-1, word);
+    uint32_t beg = findBeg(0, numIdxs()-1, word);
     if (beg == 0)
         return make_pair(0,0);
     
     size_t end = beg;
     for (;beg != 0; --beg)
-        if (strncmp(word, &d_vocab[d_idxs[beg]], strlen(word))!= 0)
+        if (strncmp(word, wordAt(beg), strlen(word))!= 0)
             break;
     
-    for (; end != d_idxs.size(); ++end)
-        if(strncmp(word, &d_vocab[d_idxs[end]], strlen(word))!= 0)
+    for (; end != numIdxs(); ++end)
+        if(strncmp(word, wordAt(end), strlen(word))!= 0)
             break;
 
     return make_pair(beg + 1, end);
@@ -179,6 +178,7 @@ void Vocab::loadBin(string const &path)
 
 void Vocab::loadBin(ifstream *ifs)
 {
+    d_mapped = nullptr;
     uint64_t size;
     ifs->read(reinterpret_cast<char*>(&size), sizeof(uint64_t));
     d_vocab = vector<char>(size);
@@ -191,9 +191,10 @@ void Vocab::loadBin(ifstream *ifs)
 
 void Vocab::optimize()
 {
-    if (d_idxs.size() > 1)
-        for (size_t beg = 1; beg != d_idxs.size(); ++beg)
-            d_collect.insert(string(&d_vocab[d_idxs[beg]]));
+    if (numIdxs() > 1)
+        for (size_t beg = 1; beg != numIdxs(); ++beg)
+            d_collect.insert(string(wordAt(beg)));
+    d_mapped = nullptr;
     d_vocab.clear();
     d_idxs.clear();
 
@@ -222,17 +223,22 @@ void Vocab::saveBin(string const &path)
 void Vocab::saveBin(ofstream *ofs)
 {
     uint64_t size;
-    size = d_vocab.size();
+    char const *words = data(&size);
     ofs->write(reinterpret_cast<char*>(&size), sizeof(uint64_t));
-    ofs->write(&d_vocab[0], sizeof(char) * size);
+    ofs->write(words, sizeof(char) * size);
 
-    size = d_idxs.size();
+    size = numIdxs();
     ofs->write(reinterpret_cast<char*>(&size), sizeof(uint64_t));
-    ofs->write(reinterpret_cast<char*>(&d_idxs[0]), sizeof(uint32_t) * d_idxs.size());
+    if (d_mapped)
+        ofs->write(d_mappedIdxs, sizeof(uint32_t) * size);
+    else
+        ofs->write(reinterpret_cast<char const*>(&d_idxs[0]), sizeof(uint32_t) * size);
 }
 
 void Vocab::addOrdered(string const &word)
 {
+    if (d_mapped)
+        optimize();
     d_idxs.push_back(d_vocab.size());
     d_vocab.resize(d_vocab.size() + word.size() + 1);
     memcpy (&d_vocab[d_vocab.size() - word.size() -1], &word[0], sizeof(char) * word.size());
@@ -256,3 +262,49 @@ void Vocab::loadOrdered(ifstream *ifs)
     while(getline((*ifs), word))
         addOrdered(word);
 }
+
+size_t Vocab::mapBin(char const *data)
+{
+    // Same layout as saveBin, read in place. The offsets are not necessarily
+    // aligned, so they are always read through memcpy.
+    char const *pos = data;
+    memcpy(&d_mappedVocabSize, pos, sizeof(uint64_t));
+    pos += sizeof(uint64_t);
+    d_mapped = pos;
+    pos += d_mappedVocabSize;
+    memcpy(&d_mappedNumIdxs, pos, sizeof(uint64_t));
+    pos += sizeof(uint64_t);
+    d_mappedIdxs = pos;
+    pos += d_mappedNumIdxs * sizeof(uint32_t);
+
+    d_vocab.clear();
+    d_idxs.clear();
+    return pos - data;
+}
+
+char const *Vocab::data(uint64_t *size)
+{
+    if (d_mapped)
+    {
+        *size = d_mappedVocabSize;
+        return d_mapped;
+    }
+    *size = d_vocab.size();
+    return &d_vocab[0];
+}
+
+size_t Vocab::numIdxs() const
+{
+    return d_mapped ? d_mappedNumIdxs : d_idxs.size();
+}
+
+char const *Vocab::wordAt(uint32_t idx) const
+{
+    if (d_mapped)
+    {
+        uint32_t offset;
+        memcpy(&offset, d_mappedIdxs + idx * sizeof(uint32_t), sizeof(uint32_t));
+        return d_mapped + offset;
+    }
+    return &d_vocab[d_idxs[idx]];
+}
@@ -15,6 +15,12 @@ class Vocab
     std::vector<char> d_vocab;
     std::vector<uint32_t> d_idxs;
 
+    // Set by mapBin, when the words are read from a mapped file instead
+    char const *d_mapped = nullptr;
+    char const *d_mappedIdxs = nullptr;
+    uint64_t d_mappedVocabSize = 0;
+    uint64_t d_mappedNumIdxs = 0;
+
     public:
         Vocab();
         Vocab(std::string const &path, bool bin = false);
@@ -24,6 +30,7 @@ class Vocab
         void saveBin(std::ofstream *ofs);
         void loadBin(std::string const &path);
         void loadBin(std::ifstream *ifs);
+        size_t mapBin(char const *data); // returns the number of bytes used
 
         void save(std::string const &path);
         void save(std::ofstream *ofs);
@@ -41,13 +48,16 @@ class Vocab
         uint32_t getId(uint32_t beg, uint32_t end, char const *searchWord);
         bool contains(std::string const &word);
         char *getWord(uint32_t id);
-        uint32_t size(){return d_idxs.size() - 1;};
+        uint32_t size(){return numIdxs() - 1;};
+        // All words, each terminated by '\0', in the order of their ids
+        char const *data(uint64_t *size);
 
         std::pair<uint32_t, uint32_t> getRange(char const *word);
         uint32_t findBeg(uint32_t beg, uint32_t end, char const *word);
 
     private:
-
+        size_t numIdxs() const;
+        char const *wordAt(uint32_t idx) const;
 };
 
 #endif
@@ -157,6 +157,12 @@ int w2v::getId(string const &word)
     return ret;
 }
 
+long long w2v::getRow(string const &word)
+{
+    int id = d_myVocab.getId(word);
+    return id == 0 ? -1 : d_vocabLink[id];
+}
+
 double w2v::distance(string const &word1, string const &word2)
 {
     int idx1 = getId(word1);
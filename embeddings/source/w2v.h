@@ -32,10 +32,14 @@ class w2v
         bool find(char const *word, std::string *bestw2, float *bestd2);
         double distance(std::string const &word1, std::string const &word2);
         int getId(std::string const &word);
+        long long getRow(std::string const &word); // -1 if unknown
     
         void printVocab();
         long long getWords(){return words;};
+        long long getSize(){return size;};
+        long long getMaxW(){return max_w;};
         char * getVocab(){return vocab;};
+        float const *getVectors(){return M;}; // Normalized, words x size
     private:
 };
         
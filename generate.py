@@ -6,45 +6,303 @@ import gzip
 import argparse
 import os
 import json
+import math
+import time
+import hashlib
+import pickle
+import mmap
+import array
+import bisect
+import struct
+import zlib
+import itertools
+import threading
+import multiprocessing
+import queue
+import random
+from collections import Counter, OrderedDict, deque
 from xml.sax.saxutils import unescape
 
-import kenlm
+try:
+    import kenlm
+except ImportError:
+    kenlm = None
 
-from embeddings import Embeds
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-class BrownClusters:
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
-    def __init__(self, paths, vocab, force_oov=False):
-        self.path_dict = dict()
-        self.token_dict = dict()
-        self._most_common = dict()
+
+class BrownClusterIndex:
+    """
+    IV and OOV views of the Brown clusters, built in a single pass over the
+    paths file. Tokens and paths are stored once, as ids, and the members of
+    every cluster are kept in arrays of token ids per view. The index can be
+    saved to a snapshot file, which is reused as long as the paths and
+    vocabulary files do not change.
+    """
+
+    version = 1
+
+    def __init__(self):
+        self.tokens = list()
+        self.token_ids = dict()
+        self.paths = list()
+        self.path_ids = dict()
+        self.token_paths = array.array('I')
+        # Per view (IV, OOV): the member token ids and most common token id of every path
+        self.members = (list(), list())
+        self.most_common = (array.array('i'), array.array('i'))
+        self.fingerprint = None
+
+    @staticmethod
+    def fingerprint_of(*paths):
+        return tuple((path, os.path.getsize(path), os.path.getmtime(path)) for path in paths)
+
+    @staticmethod
+    def build(paths, vocab):
+        index = BrownClusterIndex()
+        path_ids = index.path_ids
+        counts = (list(), list())
         with open(paths, 'r', encoding='utf-8', newline='\n') as f:
             for line in f:
                 path, token, count = line.split('\t')
                 count = int(count)
-                if path not in self.path_dict:
-                    self.path_dict[path] = set()
-                    self._most_common[path] = ('', 0)
-                is_iv = vocab.contains_word(token)
-                if force_oov:
-                    is_iv = not is_iv
-                if is_iv:
-                    if count > self._most_common.get(path, ('', 0))[1]:
-                        self._most_common[path] = token, count
-                    self.path_dict[path].add(token)
-                self.token_dict[token] = path
+                path_id = path_ids.get(path)
+                if path_id is None:
+                    path_id = path_ids[path] = len(index.paths)
+                    index.paths.append(path)
+                    for view in (0, 1):
+                        index.members[view].append(array.array('I'))
+                        index.most_common[view].append(-1)
+                        counts[view].append(0)
+                token_id = index.token_ids.get(token)
+                if token_id is None:
+                    token_id = index.token_ids[token] = len(index.tokens)
+                    index.tokens.append(token)
+                    index.token_paths.append(path_id)
+                else:
+                    index.token_paths[token_id] = path_id
+                view = 0 if vocab.contains_word(token) else 1
+                index.members[view][path_id].append(token_id)
+                if count > counts[view][path_id]:
+                    counts[view][path_id] = count
+                    index.most_common[view][path_id] = token_id
+        return index
+
+    def save(self, path):
+        # Written next to the snapshot first, so readers never load a partial snapshot
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary, 'wb') as f:
+            pickle.dump((BrownClusterIndex.version,
+                         self.fingerprint,
+                         self.tokens,
+                         self.paths,
+                         self.token_paths,
+                         self.members,
+                         self.most_common),
+                        f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            contents = pickle.load(f)
+        if contents[0] != BrownClusterIndex.version:
+            raise ValueError('Unsupported Brown cluster snapshot: {}'.format(path))
+        index = BrownClusterIndex()
+        _, index.fingerprint, index.tokens, index.paths, index.token_paths, \
+            index.members, index.most_common = contents
+        index.token_ids = {token: token_id for token_id, token in enumerate(index.tokens)}
+        index.path_ids = {path: path_id for path_id, path in enumerate(index.paths)}
+        return index
+
+    def view(self, force_oov=False):
+        return BrownClusterView(self, 1 if force_oov else 0)
+
+
+class BrownClusterView:
+    """Brown cluster suggestions restricted to either the IV or the OOV members."""
+
+    def __init__(self, index, view):
+        self.index = index
+        self.view = view
+        self._suggestions = dict()
+        self._abbreviations = dict()
 
     def suggest(self, token):
-        if token not in self.token_dict:
-            return set()
-        return self.path_dict[self.token_dict[token]]
+        token_id = self.index.token_ids.get(token)
+        if token_id is None:
+            return ()
+        path_id = self.index.token_paths[token_id]
+        suggestions = self._suggestions.get(path_id)
+        if suggestions is None:
+            tokens = self.index.tokens
+            suggestions = tuple(tokens[member] for member in self.index.members[self.view][path_id])
+            self._suggestions[path_id] = suggestions
+        return suggestions
+
+    def abbreviations(self, token):
+        """Returns the AbbreviationIndex of the members of the cluster of token."""
+        token_id = self.index.token_ids.get(token)
+        path_id = self.index.token_paths[token_id] if token_id is not None else None
+        abbreviations = self._abbreviations.get(path_id)
+        if abbreviations is None:
+            abbreviations = AbbreviationIndex(self.suggest(token))
+            self._abbreviations[path_id] = abbreviations
+        return abbreviations
 
     def get_path(self, token):
-        return self.token_dict.get(token, '')
+        token_id = self.index.token_ids.get(token)
+        if token_id is None:
+            return ''
+        return self.index.paths[self.index.token_paths[token_id]]
 
     def most_common(self, path):
-        return self._most_common.get(path, '')[0]
+        path_id = self.index.path_ids.get(path)
+        if path_id is None:
+            return ''
+        token_id = self.index.most_common[self.view][path_id]
+        return self.index.tokens[token_id] if token_id >= 0 else ''
+
+
+class AbbreviationIndex:
+    """
+    Finds the members of a Brown cluster which best match a token with
+    Scorer.abbreviation_score, without scoring every member. The members are
+    stored in bitsets (bit i for member i) per letter, per letter and
+    position, and per length. From those, an upper bound of the score of all
+    members is computed at once, from the longest run of letters which can
+    match at all. Only members whose bound can reach the best score so far
+    are scored.
+    """
+
+    def __init__(self, members):
+        self.members = members
+        self.all = (1 << len(members)) - 1
+        self.letters = dict()
+        self.positions = list()
+        self.lengths = dict()
+        for i, member in enumerate(members):
+            bit = 1 << i
+            while len(self.positions) < len(member):
+                self.positions.append(dict())
+            for position, letter in enumerate(member):
+                self.letters[letter] = self.letters.get(letter, 0) | bit
+                self.positions[position][letter] = self.positions[position].get(letter, 0) | bit
+            self.lengths[len(member)] = self.lengths.get(len(member), 0) | bit
+
+    @staticmethod
+    def bits(bitset):
+        """The members in a bitset, in increasing order."""
+        while bitset:
+            lowest = bitset & -bitset
+            yield lowest.bit_length() - 1
+            bitset ^= lowest
+
+    @staticmethod
+    def runs(bitsets):
+        """
+        For every length k, the members which are in k consecutive bitsets,
+        as long as there are any.
+        """
+        current = list(bitsets)
+        runs = list()
+        for k in range(1, len(bitsets) + 1):
+            members = 0
+            for start in range(len(bitsets) - k + 1):
+                if k > 1:
+                    current[start] &= bitsets[start + k - 1]
+                members |= current[start]
+            if not members:
+                break
+            runs.append(members)
+        return runs
+
+    def _best(self, groups, score, threshold):
+        """
+        Scores the members of (bound, bitset) groups, in order of decreasing
+        bound, and returns the set of members with the best score.
+        """
+        best_score = 0
+        best = 0
+        for bound, members in sorted(groups, key=lambda group: group[0], reverse=True):
+            if bound < best_score or bound <= threshold:
+                break
+            for i in AbbreviationIndex.bits(members):
+                member_score = score(self.members[i])
+                if member_score > best_score:
+                    best_score = member_score
+                    best = 1 << i
+                elif member_score == best_score:
+                    best |= 1 << i
+        return {self.members[i] for i in AbbreviationIndex.bits(best)}, best_score
+
+    def best_matches(self, abbreviation, threshold=0):
+        """
+        Same as Scorer.abbreviation_best_matches over the members, as long as
+        the best score is above threshold. Lower scores are not computed.
+        """
+        if not self.members:
+            return set(), 0
+        # A member can match at most as many letters of the abbreviation in a
+        # row as it contains
+        runs = self.runs([self.letters.get(letter, 0) for letter in abbreviation])
+        if not runs:
+            # Nothing matches, every member scores 0
+            return set(self.members), 0
+        groups = list()
+        for k, members in enumerate(runs, 1):
+            if k < len(runs):
+                members &= ~runs[k]
+            groups.append((k / len(abbreviation), members))
+        return self._best(groups,
+                          lambda member: Scorer.abbreviation_score(abbreviation, member),
+                          threshold)
+
+    def best_matches_reverse(self, full_word, threshold=0):
+        """
+        Same as Scorer.abbreviation_best_matches_reverse over the members, as
+        long as the best score is above threshold. Lower scores are not
+        computed.
+        """
+        if not self.members:
+            return set(), 0
+        letters = set(full_word)
+        # A member can match at most as many of its letters in a row as occur
+        # in the full word, and no more than the length of the full word
+        in_word = list()
+        for position in self.positions:
+            members = 0
+            for letter in letters:
+                members |= position.get(letter, 0)
+            in_word.append(members)
+        runs = self.runs(in_word)
+        if not runs:
+            return set(self.members), 0
+        groups = list()
+        for k, members in enumerate(runs, 1):
+            if k < len(runs):
+                members &= ~runs[k]
+            for length, length_members in self.lengths.items():
+                if members & length_members:
+                    groups.append((min(k, len(full_word)) / length, members & length_members))
+        return self._best(groups,
+                          lambda member: Scorer.abbreviation_score(member, full_word),
+                          threshold)
 
 
 class SuggestionTree:
@@ -82,6 +340,20 @@ class SuggestionTree:
         except KeyError:
             return False
 
+    def prefix_lengths(self, word):
+        """Returns the lengths of the prefixes of word which are in the tree, in increasing order."""
+        if self.ignore_case:
+            word = word.lower()
+        current_dict = self.contents.get(self.delimiter, dict())
+        lengths = [0] if self.delimiter in current_dict else []
+        for length, letter in enumerate(word, 1):
+            current_dict = current_dict.get(letter)
+            if current_dict is None:
+                break
+            if self.delimiter in current_dict:
+                lengths.append(length)
+        return lengths
+
     def suggest(self, word, depth=2):
         if self.ignore_case:
             word = word.lower()
@@ -126,41 +398,610 @@ class SuggestionTree:
         return results
 
 
-class Scorer:
+class CompactSuggestionTree:
+    """
+    Read-only SuggestionTree stored in flat arrays. The children of node n are
+    the edges offsets[n]:offsets[n+1], sorted by the code point in labels and
+    pointing to the nodes in targets. The arrays can be saved to a binary file
+    and memory-mapped, so processes share the pages instead of rebuilding the
+    tree from the vocabulary.
+    """
+
+    magic = b'STREE\x00\x00\x01'
+    header = struct.Struct('<8sQQQQ')
+    # Number of decoded nodes kept around for suggest()
+    children_cache_size = 100000
+
+    def __init__(self, offsets, labels, targets, delimiter=';', ignore_case=False):
+        self.offsets = offsets
+        self.labels = labels
+        self.targets = targets
+        self.delimiter = delimiter
+        self.ignore_case = ignore_case
+        self._mmap = None
+        self._children = dict()
+
+    @staticmethod
+    def from_tree(tree):
+        offsets = array.array('I', [0])
+        labels = array.array('I')
+        targets = array.array('I')
+        # Breadth first, so the node ids are assigned in the order they are queued
+        queue = deque([tree.contents])
+        next_node = 1
+        while queue:
+            current_dict = queue.popleft()
+            for letter in sorted(current_dict, key=ord):
+                labels.append(ord(letter))
+                targets.append(next_node)
+                queue.append(current_dict[letter])
+                next_node += 1
+            offsets.append(len(labels))
+        return CompactSuggestionTree(offsets, labels, targets,
+                                     tree.delimiter, tree.ignore_case)
+
+    def save(self, path):
+        # Written next to the index first, so readers never map a partial index
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary, 'wb') as f:
+            f.write(self.header.pack(self.magic,
+                                     ord(self.delimiter),
+                                     int(self.ignore_case),
+                                     len(self.offsets),
+                                     len(self.labels)))
+            for values in (self.offsets, self.labels, self.targets):
+                values.tofile(f)
+        os.replace(temporary, path)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, delimiter, ignore_case, num_offsets, num_edges = \
+            CompactSuggestionTree.header.unpack_from(contents)
+        if magic != CompactSuggestionTree.magic:
+            raise ValueError('{} is not a vocabulary index'.format(path))
+        view = memoryview(contents)
+        start = CompactSuggestionTree.header.size
+        arrays = list()
+        for length in (num_offsets, num_edges, num_edges):
+            end = start + length * 4
+            arrays.append(view[start:end].cast('I'))
+            start = end
+        tree = CompactSuggestionTree(*arrays,
+                                     delimiter=chr(delimiter),
+                                     ignore_case=bool(ignore_case))
+        tree._mmap = contents
+        return tree
+
+    def child(self, node, letter):
+        """Returns the node reached from node by letter, or -1."""
+        start = self.offsets[node]
+        end = self.offsets[node+1]
+        label = ord(letter)
+        index = bisect.bisect_left(self.labels, label, start, end)
+        if index < end and self.labels[index] == label:
+            return self.targets[index]
+        return -1
+
+    def children(self, node):
+        """Returns the (letter, node) pairs below node, decoded on first use."""
+        try:
+            return self._children[node]
+        except KeyError:
+            pass
+        if len(self._children) >= self.children_cache_size:
+            self._children.clear()
+        start = self.offsets[node]
+        end = self.offsets[node+1]
+        children = tuple(zip(map(chr, self.labels[start:end]), self.targets[start:end]))
+        self._children[node] = children
+        return children
+
+    def contains_word(self, word):
+        if self.ignore_case:
+            word = word.lower()
+        word = self.delimiter + word + self.delimiter
+        node = 0
+        for letter in word:
+            node = self.child(node, letter)
+            if node < 0:
+                return False
+        return True
+
+    def prefix_lengths(self, word):
+        """Returns the lengths of the prefixes of word which are in the tree, in increasing order."""
+        if self.ignore_case:
+            word = word.lower()
+        node = self.child(0, self.delimiter)
+        lengths = list()
+        for length in range(len(word) + 1):
+            if node < 0:
+                break
+            if self.child(node, self.delimiter) >= 0:
+                lengths.append(length)
+            if length < len(word):
+                node = self.child(node, word[length])
+        return lengths
+
+    def suggest(self, word, depth=2):
+        if self.ignore_case:
+            word = word.lower()
+        word = word + self.delimiter
+        # Position, current word, node in the tree, depth
+        paths = [(0, '', self.child(0, self.delimiter), 0)]
+        results = set()
+        while paths:
+            index, current_part, node, current_depth = paths.pop()
+            if index == len(word) or node < 0:
+                continue
+            next_letter = word[index]
+            for letter_option, target in self.children(node):
+                if letter_option == next_letter:
+                    # Correct path
+                    if letter_option == self.delimiter:
+                        # Result found
+                        results.add(current_part)
+                    else:
+                        # Going towards goal
+                        paths.append((index+1,
+                                      current_part+next_letter,
+                                      target,
+                                      current_depth))
+                elif current_depth < depth:
+                    # Insertion
+                    paths.append((index,
+                                  current_part+letter_option,
+                                  target,
+                                  current_depth+1))
+                    # Substitution
+                    paths.append((index+1,
+                                  current_part+letter_option,
+                                  target,
+                                  current_depth+1))
+            if current_depth < depth:
+                # Deletion
+                paths.append((index+1,
+                              current_part,
+                              node,
+                              current_depth+1))
+        return results
+
+
+class CompoundSplitter:
+    """
+    Finds the positions at which a token can be split into two vocabulary
+    words, of at least 2 and 3 letters. Instead of looking up every prefix and
+    suffix, the token is walked once through the vocabulary tree, and once
+    backwards through a tree of the reversed vocabulary words. With
+    --allow-compounds, every token of every tweet is checked with splits(), so
+    the split positions of recently seen tokens are kept in an LRUCache;
+    other callers, which are behind the candidate cache, use find_splits().
+    """
+
+    def __init__(self, vocabulary, reversed_vocabulary, capacity=100000):
+        self.vocabulary = vocabulary
+        self.reversed_vocabulary = reversed_vocabulary
+        self.cache = LRUCache(capacity)
+
+    def splits(self, token):
+        positions = self.cache.get(token)
+        if positions is None:
+            positions = self.find_splits(token)
+            self.cache.put(token, positions)
+        return positions
+
+    def find_splits(self, token):
+        candidates = range(2, len(token)-2)
+        if not candidates:
+            return ()
+        word = token
+        if self.vocabulary.ignore_case:
+            word = token.lower()
+            # Lower casing some letters changes the length of the token, or
+            # depends on the letters around them (final sigma), so that the
+            # parts have to be lower cased separately
+            if len(word) != len(token) or 'Σ' in token:
+                return tuple(i for i in candidates
+                             if self.vocabulary.contains_word(token[:i])
+                             and self.vocabulary.contains_word(token[i:]))
+        prefixes = set(self.vocabulary.prefix_lengths(word))
+        suffixes = set(len(word) - length for length in self.reversed_vocabulary.prefix_lengths(word[::-1]))
+        return tuple(i for i in candidates if i in prefixes and i in suffixes)
+
+
+class DeletionIndex:
+    """
+    Typo candidate generator with the same interface as SuggestionTree, based
+    on symmetric deletions (SymSpell). Every vocabulary word is indexed under
+    all variants of its prefix with up to max_depth characters deleted. A query
+    only generates the deletions of its own prefix and verifies the words found
+    under them, instead of exploring the whole tree.
+    """
+
+    def __init__(self, max_depth=2, prefix_length=7, ignore_case=False):
+        self.max_depth = max_depth
+        self.prefix_length = prefix_length
+        self.ignore_case = ignore_case
+        self.words = set()
+        # One index per number of deleted characters
+        self.deletions = [dict() for _ in range(max_depth + 1)]
+
+    @staticmethod
+    def delete_variants(word, depth):
+        """Returns the variants of word, grouped by the number of deletions."""
+        variants = [{word}]
+        seen = {word}
+        for _ in range(depth):
+            current = {part[:i] + part[i+1:] for part in variants[-1] for i in range(len(part))}
+            current -= seen
+            seen |= current
+            variants.append(current)
+        return variants
+
+    def add_word(self, word):
+        if self.ignore_case:
+            word = word.lower()
+        if word in self.words:
+            return
+        self.words.add(word)
+        variants = DeletionIndex.delete_variants(word[:self.prefix_length], self.max_depth)
+        for deletions, level in zip(self.deletions, variants):
+            for variant in level:
+                if variant not in deletions:
+                    deletions[variant] = [word]
+                else:
+                    deletions[variant].append(word)
+
+    def add_words(self, list_of_words):
+        for word in list_of_words:
+            self.add_word(word)
+
+    def contains_word(self, word):
+        if self.ignore_case:
+            word = word.lower()
+        return word in self.words
 
-    def __init__(self, language_model):
+    def suggest(self, word, depth=2):
+        if depth > self.max_depth:
+            raise ValueError('DeletionIndex was built for a depth of at most {}'.format(
+                    self.max_depth))
+        if self.ignore_case:
+            word = word.lower()
+        results = set()
+        seen = set()
+        variants = set().union(*DeletionIndex.delete_variants(word[:self.prefix_length], depth))
+        # Both sides need at most depth deletions to meet
+        for deletions in self.deletions[:depth+1]:
+            for variant in variants:
+                for candidate in deletions.get(variant, ()):
+                    if candidate in seen:
+                        continue
+                    seen.add(candidate)
+                    if Scorer.levenshtein(word, candidate, depth) <= depth:
+                        results.add(candidate)
+        return results
+
+
+class LRUCache:
+    """
+    Bounded mapping which evicts the least recently used entry once it
+    contains more than capacity entries. A capacity of 0 disables caching.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key, default=None):
+        """Like get, without counting the lookup or marking the entry as used."""
+        return self.entries.get(key, default)
+
+    def put(self, key, value):
+        if self.capacity <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def take_statistics(self):
+        """Returns the counters since the previous call, and resets them."""
+        statistics = {'hits': self.hits,
+                      'misses': self.misses,
+                      'evictions': self.evictions}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        return statistics
+
+
+class ScoreCache:
+    """
+    Memoizes language model scores of (previous words, word, next words)
+    windows, which are scored over and over again across a corpus. Windows
+    are scored incrementally with KenLM's state API: the state after the
+    previous words is cached as well, so the candidates for a position only
+    score their own words and the next words. Below that, the score of every
+    word after the (order - 1) words before it is cached with the state after
+    it, as KenLM's state only depends on those words. Whole sentences reuse
+    those scores, of the words which windows or earlier sentences scored in
+    the same context, instead of scoring every word again. Scores are
+    accumulated in single precision, like Model.score does, so they are
+    identical.
+    """
+
+    float32 = struct.Struct('f')
+
+    def __init__(self, language_model, capacity=500000, state_class=None):
         self.model = language_model
+        self.state_class = state_class or kenlm.State
+        self.context_size = language_model.order - 1
+        self.cache = LRUCache(capacity)
+        self.contexts = LRUCache(capacity // 10)
+        # (previous words, word) -> (score, state after the word)
+        self.ngrams = LRUCache(capacity)
+        self.start = None
+
+    def advance(self, context, state, total, words):
+        """
+        Scores words after the context words and their state, and returns the
+        context, state and total after them.
+        """
+        float32 = self.float32
+        for word in words:
+            key = (context, word)
+            entry = self.ngrams.get(key)
+            if entry is None:
+                next_state = self.state_class()
+                entry = (float32.unpack(float32.pack(self.model.BaseScore(state, word, next_state)))[0],
+                         next_state)
+                self.ngrams.put(key, entry)
+            score, state = entry
+            total = float32.unpack(float32.pack(total + score))[0]
+            context = (context + (word,))[max(0, len(context) + 1 - self.context_size):]
+        return context, state, total
+
+    def context(self, previous_words, bos):
+        """The context words, state and score after the previous words."""
+        key = (previous_words, bos)
+        context = self.contexts.get(key)
+        if context is None:
+            state = self.state_class()
+            if bos:
+                self.model.BeginSentenceWrite(state)
+            else:
+                self.model.NullContextWrite(state)
+            context = self.advance(('<s>',) if bos else (), state, 0.0, previous_words.split())
+            self.contexts.put(key, context)
+        return context
+
+    def score(self, previous_words, word, next_words, bos=None, eos=None):
+        """
+        Model.score of the window, where word may consist of several words.
+        By default, the window starts the sentence when there are no previous
+        words, and ends it when there are no next words.
+        """
+        if bos is None:
+            bos = previous_words == ''
+        if eos is None:
+            eos = next_words == ''
+        key = (previous_words, word, next_words, bos, eos)
+        score = self.cache.get(key)
+        if score is None:
+            score = self.score_after(self.context(previous_words, bos), word, next_words, eos)
+            self.cache.put(key, score)
+        return score
+
+    def score_after(self, context, word, next_words, eos):
+        """The score of a window after its context words, state and score."""
+        context, state, score = self.advance(*context, word.split())
+        context, state, score = self.advance(context, state, score, next_words.split())
+        if eos:
+            context, state, score = self.advance(context, state, score, ('</s>',))
+        return score
+
+    def score_many(self, windows):
+        """
+        Scores the (previous words, word, next words, bos, eos) windows which
+        are not cached yet, and caches them. The windows are grouped by their
+        previous words, so the context of a group is only looked up once.
+        """
+        if self.cache.capacity <= 0:
+            return
+        groups = dict()
+        for window in dict.fromkeys(windows):
+            if self.cache.peek(window) is None:
+                previous_words, word, next_words, bos, eos = window
+                groups.setdefault((previous_words, bos), list()).append((word, next_words, eos))
+        for (previous_words, bos), group in groups.items():
+            context = self.context(previous_words, bos)
+            for word, next_words, eos in group:
+                self.cache.put((previous_words, word, next_words, bos, eos),
+                               self.score_after(context, word, next_words, eos))
+
+    def sentence_score(self, words):
+        """Model.score of a whole sentence of words, some of which may consist of several words."""
+        if self.start is None:
+            self.start = self.state_class()
+            self.model.BeginSentenceWrite(self.start)
+        words = [part for word in words for part in word.split()]
+        words.append('</s>')
+        return self.advance(('<s>',), self.start, 0.0, words)[2]
+
+class CandidateCache:
+    """
+    Memoizes the candidates of a token which do not depend on its context,
+    per mode ('clean' or 'noisify'): the typo suggestions, and the other
+    candidates with their sources, in the order they were found. The cache
+    can be saved between runs, with a fingerprint of the resources and
+    settings the candidates were generated with.
+    """
+
+    version = 1
+
+    def __init__(self, capacity=100000, fingerprint=None):
+        self.cache = LRUCache(capacity)
+        self.fingerprint = fingerprint
+
+    def candidates(self, mode, token, generate):
+        """Returns the cached candidates of token, or stores those of generate(token)."""
+        key = (mode, token)
+        candidates = self.cache.get(key)
+        if candidates is None:
+            candidates = generate(token)
+            self.cache.put(key, candidates)
+        return candidates
+
+    def peek(self, mode, token):
+        """The cached candidates of token, None if they are not cached."""
+        return self.cache.peek((mode, token))
+
+    def fill(self, keys, generate_many):
+        """
+        Stores the candidates of the (mode, token) keys which are not cached
+        yet, all of which are generated by one generate_many(keys) call.
+        """
+        if self.cache.capacity <= 0:
+            return
+        missing = [key for key in dict.fromkeys(keys) if self.cache.peek(key) is None]
+        if missing:
+            for key, candidates in zip(missing, generate_many(missing)):
+                self.cache.put(key, candidates)
+
+    def save(self, path):
+        # A temporary file per process, as jobs which share a cache may save it at the same time
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary, 'wb') as f:
+            pickle.dump((CandidateCache.version,
+                         self.fingerprint,
+                         list(self.cache.entries.items())),
+                        f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)
+
+    def load(self, path):
+        """Adds the entries saved in path, if they were made with the same fingerprint."""
+        with open(path, 'rb') as f:
+            version, fingerprint, entries = pickle.load(f)
+        if version != CandidateCache.version or fingerprint != self.fingerprint:
+            return False
+        for key, candidates in entries[-self.cache.capacity:] if self.cache.capacity > 0 else ():
+            self.cache.put(key, candidates)
+        return True
+
+
+class Scorer:
+
+    def __init__(self, scores):
+        self.scores = scores
+
+    # Minimum number of suggestions before levenshtein_many uses NumPy
+    vectorize_threshold = 16
 
     @staticmethod
-    def levenshtein(token1, token2):
-        if not token1 and not token2:
-            return 0
-        elif not token1:
-            return len(token2)
-        elif not token2:
-            return len(token1)
-        matrix = [[i for i in range(len(token2) + 1)]]
-        for i, char1 in enumerate(token1):
-            matrix.append([i+1])
-            for j, char2 in enumerate(token2):
-                possibilities = []
-                possibilities.append(matrix[i][j+1] + 1)
-                possibilities.append(matrix[i][j] + (not char1 == char2))
-                if i+1 < len(matrix):
-                    possibilities.append(matrix[i+1][j] + 1)
-                matrix[i+1].append(min(possibilities))
-        return matrix[i+1][j+1]
-
-    def best_match(self, token, suggestions, previous_word, next_word):
+    def levenshtein(token1, token2, max_distance=None):
+        """
+        Edit distance between two tokens. With max_distance, only a band of
+        that width around the diagonal is computed, and max_distance + 1 is
+        returned as soon as the distance is known to be larger.
+        """
+        # A common prefix and suffix do not change the distance
+        prefix = 0
+        shortest = min(len(token1), len(token2))
+        while prefix < shortest and token1[prefix] == token2[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < shortest - prefix and token1[-1-suffix] == token2[-1-suffix]:
+            suffix += 1
+        token1 = token1[prefix:len(token1)-suffix]
+        token2 = token2[prefix:len(token2)-suffix]
+        if max_distance is None:
+            max_distance = max(len(token1), len(token2))
+        limit = max_distance + 1
+        if abs(len(token1) - len(token2)) > max_distance:
+            return limit
+        if not token1 or not token2:
+            return max(len(token1), len(token2))
+        previous_row = [j if j < limit else limit for j in range(len(token2) + 1)]
+        for i, char1 in enumerate(token1, 1):
+            first = max(1, i - max_distance)
+            last = min(len(token2), i + max_distance)
+            current_row = [limit] * (len(token2) + 1)
+            if i < limit:
+                current_row[0] = i
+            row_minimum = current_row[first-1]
+            for j in range(first, last + 1):
+                distance = min(previous_row[j] + 1,
+                               previous_row[j-1] + (char1 != token2[j-1]),
+                               current_row[j-1] + 1,
+                               limit)
+                current_row[j] = distance
+                if distance < row_minimum:
+                    row_minimum = distance
+            if row_minimum >= limit:
+                return limit
+            previous_row = current_row
+        return previous_row[-1]
+
+    @staticmethod
+    def levenshtein_many(token, suggestions, max_distance=None):
+        """
+        Edit distances between a token and every suggestion, in the order of
+        suggestions. Larger batches are computed with NumPy when it is
+        available, one row of the distance matrix for all suggestions at once.
+        """
+        suggestions = list(suggestions)
+        if numpy is None or len(suggestions) < Scorer.vectorize_threshold or not token:
+            return [Scorer.levenshtein(token, suggestion, max_distance)
+                    for suggestion in suggestions]
+        lengths = numpy.array([len(suggestion) for suggestion in suggestions])
+        width = int(lengths.max())
+        # Code points of the suggestions, padded with -1 which matches nothing
+        encoded = numpy.full((len(suggestions), width), -1, dtype=numpy.int64)
+        for row, suggestion in enumerate(suggestions):
+            encoded[row, :len(suggestion)] = numpy.frombuffer(
+                    suggestion.encode('utf-32-le'), dtype=numpy.uint32)
+        columns = numpy.arange(width + 1)
+        previous_row = numpy.tile(columns, (len(suggestions), 1))
+        for i, char in enumerate(token, 1):
+            current_row = numpy.empty_like(previous_row)
+            current_row[:, 0] = i
+            current_row[:, 1:] = numpy.minimum(previous_row[:, 1:] + 1,
+                                               previous_row[:, :-1] + (encoded != ord(char)))
+            # Insertions: row[j] = min over k <= j of row[k] + (j - k)
+            current_row = numpy.minimum.accumulate(current_row - columns, axis=1) + columns
+            previous_row = current_row
+        distances = previous_row[numpy.arange(len(suggestions)), lengths]
+        if max_distance is not None:
+            distances = numpy.minimum(distances, max_distance + 1)
+        return distances.tolist()
+
+    def best_match(self, token, suggestions, previous_word, next_word, bos=None, eos=None):
         best_match = '', 0
         if not token:
             return best_match
-        for suggestion in suggestions:
-            prior_probability = 10**self.model.score('{} {} {}'.format(
-                    previous_word, suggestion, next_word),
-                    bos=(previous_word == ''),
-                    eos=(next_word == ''))
-            distance = Scorer.levenshtein(token, suggestion)
+        suggestions = list(suggestions)
+        distances = Scorer.levenshtein_many(token, suggestions)
+        for suggestion, distance in zip(suggestions, distances):
+            prior_probability = 10**self.scores.score(previous_word, suggestion, next_word, bos, eos)
             ratio = distance / len(token)
             # Same token, very likely to be correct
             if ratio == 0:
@@ -219,40 +1060,396 @@ class Scorer:
 
 class TweetJsonReader:
 
+    newlines_re = re.compile('\n+')
+
     def __init__(self, *paths):
         self.paths = paths
 
+    @staticmethod
+    def parse(line):
+        """Returns the text of a tweet, or None for retweets and truncated tweets."""
+        try:
+            return TweetJsonReader.text(json_loads(line))
+        except ValueError:
+            pass
+        # The standard parser also accepts lone surrogates, which occur in cut
+        # off tweets but cannot be written or scored, so those are skipped
+        text = TweetJsonReader.text(json.loads(line))
+        try:
+            text.encode('utf-8')
+        except (AttributeError, UnicodeEncodeError):
+            return None
+        return text
+
+    @staticmethod
+    def text(data):
+        if 'retweeted_status' not in data:
+            if 'extended_tweet' in data:
+                text = unescape(data.get('extended_tweet').get('full_text'))
+                return TweetJsonReader.newlines_re.sub(' ', text)
+            elif not data.get('truncated'):
+                return unescape(TweetJsonReader.newlines_re.sub(' ', data.get('text')))
+        return None
+
     def readlines(self):
         for path in self.paths:
-            with gzip.open(path, 'rt', encoding='utf-8') as f:
+            with gzip.open(path, 'rb') as f:
                 for line in f:
-                    data = json.loads(line.strip())
-                    if 'retweeted_status' not in data:
-                        if 'extended_tweet' in data:
-                            text = unescape(data.get('extended_tweet').get('full_text'))
-                            yield re.sub('\n+', ' ', text)
-                        elif not data.get('truncated'):
-                            yield unescape(re.sub('\n+', ' ', data.get('text')))
+                    text = TweetJsonReader.parse(line.strip())
+                    if text is not None:
+                        yield text
 
 
-class Writer:
+class InputReader:
+    """
+    Streams the tweets of several input files, in order. Plain text files
+    contain one tweet per line, gzipped Twitter JSON dumps (.json.gz) are
+    decompressed and parsed on the fly. Every file is read by a background
+    thread, at most readers files ahead, into a bounded queue of batches.
+
+    position is the (file index, tweets, byte offset) just after the last
+    tweet that was yielded, and can be passed as start to continue from there.
+    Plain text files are seeked to the byte offset, compressed files are read
+    again up to the number of tweets.
+    """
+
+    def __init__(self, paths, readers=2, batch_size=1000, queue_size=16, start=None):
+        self.paths = paths
+        self.readers = max(1, readers)
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.start = tuple(start) if start else (0, 0, 0)
+        self.position = self.start
 
-    def __init__(self, path):
+    @staticmethod
+    def lines(path, tweets=0, offset=0):
+        """Yields (tweet, byte offset after it) pairs, the offset is None for compressed files."""
+        if path.endswith('.gz'):
+            if path.endswith('.json.gz'):
+                lines = TweetJsonReader(path).readlines()
+            else:
+                lines = gzip.open(path, 'rt', encoding='utf-8', newline='\n')
+            for line in itertools.islice(lines, tweets, None):
+                yield line, None
+        else:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    offset += len(line)
+                    yield line.decode('utf-8'), offset
+
+    def _read(self, lines, batches):
+        try:
+            for batch in chunks(lines, self.batch_size):
+                batches.put(batch)
+            batches.put(None)
+        except BaseException as error:
+            batches.put(error)
+
+    def _start(self, file_index):
+        batches = queue.Queue(self.queue_size)
+        if file_index == self.start[0]:
+            lines = InputReader.lines(self.paths[file_index], *self.start[1:])
+        else:
+            lines = InputReader.lines(self.paths[file_index])
+        threading.Thread(target=self._read, args=(lines, batches), daemon=True).start()
+        return file_index, batches
+
+    def __iter__(self):
+        file_indices = iter(range(self.start[0], len(self.paths)))
+        started = deque(self._start(file_index)
+                        for file_index in itertools.islice(file_indices, self.readers))
+        while started:
+            file_index, batches = started.popleft()
+            tweets, offset = self.start[1:] if file_index == self.start[0] else (0, 0)
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                if isinstance(batch, BaseException):
+                    raise batch
+                for line, offset in batch:
+                    tweets += 1
+                    self.position = (file_index, tweets, offset or 0)
+                    yield line
+            self.position = (file_index + 1, 0, 0)
+            for next_index in itertools.islice(file_indices, 1):
+                started.append(self._start(next_index))
+
+
+class Checkpoint:
+    """
+    Periodically records how far the input has been processed, together with
+    the number of bytes written to both outputs at that point. A run can be
+    resumed from it by truncating the outputs to those sizes and continuing
+    the input from the recorded position. With a Quota, its counts are
+    recorded as well, and with a Deduplicator, the tweets it has seen are
+    saved to a file next to the checkpoint.
+    """
+
+    def __init__(self, path, data, writers, interval=300, quota=None, deduplicator=None, state=None):
         self.path = path
+        self.data = data
+        self.writers = writers
+        self.interval = interval
+        self.quota = quota
+        self.deduplicator = deduplicator
+        # The duplicate filter of the checkpoint which was resumed from, or saved last
+        self.dedup_path = state.get('dedup') if state else None
+        self.saves = 0
+        self.last_save = time.monotonic()
+
+    @staticmethod
+    def load(path, data):
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if state['data'] != list(data):
+            raise ValueError('Checkpoint {} was made for different input files'.format(path))
+        return state
+
+    def due(self):
+        return time.monotonic() - self.last_save >= self.interval
+
+    def save(self, position):
+        state = {'data': list(self.data),
+                 'position': list(position),
+                 'outputs': [writer.checkpoint() for writer in self.writers]}
+        if self.quota:
+            state['quota'] = self.quota.counts
+        if self.deduplicator:
+            # A new file every time, so the previous checkpoint stays intact until it is replaced
+            self.saves += 1
+            dedup_path = '{}.dedup-{}-{}'.format(self.path, os.getpid(), self.saves)
+            self.deduplicator.save(dedup_path)
+            state['dedup'] = dedup_path
+        # Written next to the checkpoint first, so a crash leaves the previous one intact
+        temporary = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+        self.last_save = time.monotonic()
+        if self.deduplicator:
+            if self.dedup_path and os.path.exists(self.dedup_path):
+                os.remove(self.dedup_path)
+            self.dedup_path = state['dedup']
+
+
+class Profiler:
+    """
+    Counts events and accumulates the time spent in each stage of the
+    generation within this process. A stage is timed by passing the time it
+    started to lap(), which returns the start time of the next stage, so
+    consecutive stages only take a single clock read each.
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self.times = Counter()
+
+    def count(self, name, value=1):
+        self.counts[name] += value
+
+    def lap(self, stage, start):
+        now = time.perf_counter()
+        self.times[stage] += now - start
+        self.counts[stage] += 1
+        return now
+
+    def take_statistics(self):
+        """Returns the counters and timings since the previous call, and resets them."""
+        statistics = Counter(self.counts)
+        for stage, seconds in self.times.items():
+            statistics[stage + ' seconds'] += seconds
+        self.counts.clear()
+        self.times.clear()
+        return statistics
+
+
+class ProfileReport:
+    """
+    Regularly writes the statistics of the run so far to a JSON file, with
+    the stage timings grouped per stage.
+    """
+
+    def __init__(self, path, interval=60):
+        self.path = path
+        self.interval = interval
+        self.started = time.monotonic()
+        self.last_save = self.started
+
+    def due(self):
+        return time.monotonic() - self.last_save >= self.interval
+
+    def save(self, statistics):
+        elapsed = time.monotonic() - self.started
+        stages = dict()
+        counters = dict()
+        for name, value in statistics.items():
+            if name.endswith(' seconds'):
+                continue
+            if name + ' seconds' in statistics:
+                seconds = statistics[name + ' seconds']
+                stages[name] = {'calls': value,
+                                'seconds': seconds,
+                                'microseconds per call': seconds / value * 1e6 if value else 0}
+            else:
+                counters[name] = value
+        report = {'elapsed seconds': elapsed,
+                  'tweets per second': statistics['tweets'] / elapsed if elapsed else 0,
+                  'language model calls': statistics['score cache misses'] + statistics['sentence scores'],
+                  'embedding lookups': statistics['clean embeddings'] + statistics['noisify embeddings'],
+                  'stages': stages,
+                  'counters': counters}
+        temporary = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        os.replace(temporary, self.path)
+        self.last_save = time.monotonic()
+
+
+class Writer:
+    """
+    Writes the token pairs of complete tweets. Tweets are collected in memory
+    and written in large batches by a background thread, so generation does
+    not wait for the disk. Outputs ending in .gz or .zst are compressed with
+    gzip or zstd; every checkpoint ends a gzip member or zstd frame, so an
+    output truncated to a checkpoint is still valid.
+    """
+
+    def __init__(self, path, resume_size=None, buffer_size=1024*1024, queue_size=16):
+        self.path = path
+        self.resume_size = resume_size
+        self.buffer_size = buffer_size
+        self.queue_size = queue_size
+        self.block = list()
+        self.pending = list()
+        self.pending_size = 0
+        self.error = None
+        self.tweets = 0
+
+    @staticmethod
+    def compressor(path):
+        if path.endswith('.gz'):
+            return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        if path.endswith('.zst'):
+            if zstandard is None:
+                raise ValueError('Writing {} requires the zstandard package'.format(path))
+            return zstandard.ZstdCompressor().compressobj()
+        return None
 
     def __enter__(self):
-        self.file = open(self.path, 'w', newline='\n')
+        self.compress = self.compressor(self.path)
+        if self.resume_size is None:
+            self.file = open(self.path, 'wb')
+        else:
+            # Drop everything written after the checkpoint
+            with open(self.path, 'r+b') as f:
+                f.truncate(self.resume_size)
+            self.file = open(self.path, 'ab')
+        self.batches = queue.Queue(self.queue_size)
+        self.thread = threading.Thread(target=self._write_batches, daemon=True)
+        self.thread.start()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.file.close()
+        try:
+            if self.error is None:
+                self._put_pending()
+        finally:
+            self.batches.put(None)
+            self.thread.join()
+            try:
+                if self.compress and self.error is None:
+                    self.file.write(self.compress.flush())
+            finally:
+                self.file.close()
+        # Raised after closing, and only when it does not hide an error of the with block
+        if self.error is not None and exc_type is None:
+            raise self.error
         return False
 
+    def _write_batches(self):
+        while True:
+            batch = self.batches.get()
+            try:
+                if batch is None:
+                    return
+                if self.error is None:
+                    data = batch.encode('utf-8')
+                    if self.compress:
+                        data = self.compress.compress(data)
+                    self.file.write(data)
+            except BaseException as error:
+                # Raised again in the generation thread
+                self.error = error
+            finally:
+                self.batches.task_done()
+
+    def _hand_off(self):
+        if self.error is not None:
+            raise self.error
+        self._put_pending()
+
+    def _put_pending(self):
+        if self.pending:
+            self.batches.put(''.join(self.pending))
+            self.pending = list()
+            self.pending_size = 0
+
     def writeTokenPair(self, original, normalized, status='-'):
-        print('{}\t{}\t{}'.format(original, status, normalized), file=self.file)
+        """Adds a token pair to the current tweet."""
+        self.block.append('{}\t{}\t{}\n'.format(original, status, normalized))
 
     def newline(self):
-        print(file=self.file)
+        self.block.append('\n')
+        self.write(''.join(self.block))
+        self.block = list()
+        self.tweets += 1
+
+    def write(self, text):
+        """Writes the text of complete tweets."""
+        self.pending.append(text)
+        self.pending_size += len(text)
+        if self.pending_size >= self.buffer_size:
+            self._hand_off()
+
+    def checkpoint(self):
+        """Writes and flushes everything to disk, and returns the size of the output."""
+        self._hand_off()
+        self.batches.join()
+        if self.error is not None:
+            raise self.error
+        if self.compress:
+            self.file.write(self.compress.flush())
+            self.compress = self.compressor(self.path)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+
+class BufferWriter(Writer):
+    """Writer which keeps its token pairs in memory, used by worker processes."""
+
+    def __init__(self):
+        super().__init__(None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def write(self, text):
+        self.pending.append(text)
+
+    def take(self):
+        text = ''.join(self.pending)
+        self.pending = list()
+        return text
 
 
 class Preprocessor:
@@ -278,31 +1475,249 @@ class Preprocessor:
           [\#\;]?\)?\)?               #right cheek
         )"""
     emoticon_re = re.compile(emoticon_string, re.VERBOSE | re.I | re.UNICODE)
+    quotes = str.maketrans('`’', "''")
+    parts_string = r"""<[UR]>|\d[\d\-/':.,]+\d|\w[\w']*\w|[.,!?;:"'()/\\]+|\S"""
+    # Tokenizes a whole line in one pass. Hashtags, users, urls and tokens
+    # starting with an emoticon are kept whole, other tokens are split into
+    # parts. The first part of every token is matched separately, since tokens
+    # starting with <U> or <R> keep their upper case parts.
+    tokens_re = re.compile(r"""
+        (?P<whole>(?<!\S)(?:[\#@]|\S*?http|(?i:{emoticon}))\S*)
+        |(?P<first>(?<!\S)(?:{parts}))
+        |(?P<part>{parts})
+        """.format(emoticon=emoticon_string, parts=parts_string), re.VERBOSE | re.UNICODE)
 
     @staticmethod
     def is_emoticon(token):
-        return re.match(Preprocessor.emoticon_re, token) is not None
+        return Preprocessor.emoticon_re.match(token) is not None
 
     @staticmethod
-    def preprocess(tokens):
+    def preprocess_line(line):
         cleaner = list()
-        for token in tokens:
-            token = re.sub('[`’]', '\'', token)
-            if token[:1] == '#' or token[:1] == '@' or 'http' in token:
-                cleaner.append(token)
-            elif Preprocessor.is_emoticon(token):
-                cleaner.append(token)
+        protected = False
+        for match in Preprocessor.tokens_re.finditer(line.translate(Preprocessor.quotes)):
+            part = match.group()
+            kind = match.lastgroup
+            if kind == 'whole':
+                cleaner.append(part)
+                continue
+            if kind == 'first':
+                protected = part == '<U>' or part == '<R>'
+            if part.isupper() and not protected:
+                cleaner.append(part.lower())
             else:
-                for part in re.findall(
-                        r"<[UR]>|\d[\d\-/':.,]+\d|\w[\w']*\w|[.,!?;:\"\'()/\\]+|\S",
-                        token):
-                    if part:
-                        if part.isupper() and not re.match(r"<[UR]>", token):
-                            cleaner.append(part.lower())
-                        else:
-                            cleaner.append(part)
+                cleaner.append(part)
         return cleaner
 
+    @staticmethod
+    def preprocess(tokens):
+        return Preprocessor.preprocess_line(' '.join(tokens))
+
+
+class BloomFilter:
+    """
+    Set membership in a fixed number of bits, without false negatives. The
+    fraction of false positives grows with the number of added items, to
+    about 1% at 10 bits per item.
+    """
+
+    num_hashes = 7
+
+    def __init__(self, num_bytes):
+        self.bits = bytearray(num_bytes)
+        self.num_bits = num_bytes * 8
+        self.count = 0
+
+    def add(self, digest):
+        """Adds a 16 byte digest, and returns whether it was (probably) added before."""
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        present = True
+        for i in range(self.num_hashes):
+            bit = (first + i * second) % self.num_bits
+            mask = 1 << (bit & 7)
+            if not self.bits[bit >> 3] & mask:
+                self.bits[bit >> 3] |= mask
+                present = False
+        if not present:
+            self.count += 1
+        return present
+
+    def false_positive_rate(self):
+        return (1 - math.exp(-self.num_hashes * self.count / self.num_bits)) ** self.num_hashes
+
+
+class Deduplicator:
+    """
+    Skips tweets which have been seen before, after preprocessing, lower
+    casing and replacing users and urls. Either the hashes of all tweets are
+    kept, or, with a memory budget in bytes, a BloomFilter, which also skips
+    a small fraction of unique tweets. The tweets seen so far can be saved
+    with a Checkpoint, and loaded again when the run is resumed.
+    """
+
+    def __init__(self, memory=None):
+        self.seen = BloomFilter(memory) if memory else set()
+        self.duplicates = 0
+
+    @staticmethod
+    def key(tokens):
+        """The digest of the preprocessed tokens of a tweet."""
+        normalized = list()
+        for token in tokens:
+            if token[:1] == '@':
+                token = '<U>'
+            elif 'http' in token:
+                token = '<R>'
+            normalized.append(token.lower())
+        return hashlib.blake2b(' '.join(normalized).encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+    def unique(self, tweets):
+        """
+        Yields the (tweet, tokens) pairs of the unique tweets, with the tokens
+        as tokenize_tweet returns them, so they are not tokenized again.
+        """
+        for tweet in tweets:
+            tokens = Preprocessor.preprocess_line(tweet)
+            digest = Deduplicator.key(tokens)
+            if isinstance(self.seen, BloomFilter):
+                duplicate = self.seen.add(digest)
+            else:
+                duplicate = digest in self.seen
+                self.seen.add(digest)
+            if duplicate:
+                self.duplicates += 1
+            else:
+                yield tweet, None if is_truncated(tweet) else tokens
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self.seen, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            seen = pickle.load(f)
+        if type(seen) is not type(self.seen) or \
+                (isinstance(seen, BloomFilter) and seen.num_bits != self.seen.num_bits):
+            raise ValueError('Duplicate filter {} was made with other --dedup settings'.format(path))
+        self.seen = seen
+
+    def take_statistics(self):
+        """Returns the counters since the previous call, and resets them."""
+        statistics = {'duplicate tweets': self.duplicates}
+        self.duplicates = 0
+        return statistics
+
+
+class Quota:
+    """
+    Numbers of tweets to clean and to noisify (None for no limit), and the
+    numbers written so far. With balance, the targets are split evenly over
+    the input files. When the files are processed in order (sequential), the
+    part of its share which a file could not fill moves to the files after it.
+    """
+
+    kinds = ('clean', 'noisify')
+
+    def __init__(self, target_clean, target_noisy, sources, balance=False, sequential=True, counts=None):
+        self.targets = (target_clean, target_noisy)
+        self.sources = sources if balance else 1
+        self.sequential = sequential
+        # Per kind, per input file (or a single count without balance)
+        self.counts = counts or [[0] * self.sources for _ in self.kinds]
+        if any(len(counts) != self.sources for counts in self.counts):
+            raise ValueError('The quota counts of the checkpoint do not match --balance-sources')
+        # The input files before this one are finished
+        self.current = 0
+
+    def _index(self, source):
+        return source if self.sources > 1 else 0
+
+    def finish_before(self, source):
+        """Marks the input files before source as finished, for sequential quotas."""
+        if self.sequential:
+            self.current = max(self.current, self._index(source))
+
+    def share(self, kind, source):
+        """The number of tweets of a kind to take from an input file, None for no limit."""
+        target = self.targets[kind]
+        if target is None:
+            return None
+        index = self._index(source)
+        first = min(self.current, index)
+        remaining = max(0, target - sum(self.counts[kind][:first]))
+        active = self.sources - first
+        return remaining // active + (1 if index - first < remaining % active else 0)
+
+    def wants(self, source):
+        """Whether to (clean, noisify) the next tweet of an input file."""
+        index = self._index(source)
+        return tuple(self.targets[kind] is None or self.counts[kind][index] < self.share(kind, source)
+                     for kind in range(len(self.kinds)))
+
+    def may_want(self, source):
+        """
+        Like wants, for tweets which are written later, after the tweets before
+        them: the shares of input files after the current one can still grow.
+        """
+        if self.sequential and self._index(source) > self.current:
+            return tuple(target is None or sum(counts) < target
+                         for target, counts in zip(self.targets, self.counts))
+        return self.wants(source)
+
+    def add(self, source, cleaned, noisified):
+        index = self._index(source)
+        self.counts[0][index] += cleaned
+        self.counts[1][index] += noisified
+
+    def done(self):
+        """Whether all targets are met; never without targets."""
+        return (any(target is not None for target in self.targets) and
+                all(target is None or sum(counts) >= target for target, counts in zip(self.targets, self.counts)))
+
+    def report(self, paths):
+        if self.done():
+            print('Stopped after meeting the quotas', file=sys.stderr)
+        for kind, target, counts in zip(('Cleaned', 'Noisified'), self.targets, self.counts):
+            if target is None:
+                print('{} {} tweets'.format(kind, sum(counts)), file=sys.stderr)
+            else:
+                print('{} {} of {} tweets{}'.format(kind, sum(counts), target,
+                                                  '' if sum(counts) >= target else ', the input ran out'),
+                      file=sys.stderr)
+            if self.sources > 1:
+                for path, count in zip(paths, counts):
+                    print('    {}: {}'.format(path, count), file=sys.stderr)
+
+
+def count_tweets(paths, readers):
+    return sum(1 for _ in InputReader(paths, readers))
+
+
+def stride_sample(tweets, size, total):
+    """Every k-th of the total tweets, in order, with k such that at most size tweets are taken."""
+    stride = max(1, -(-total // size))
+    return itertools.islice(tweets, 0, None, stride)
+
+
+def reservoir_sample(tweets, size, rng):
+    """
+    A uniform random sample of size tweets (algorithm R), in random order, so
+    any number of tweets taken from its start is spread over the whole input.
+    """
+    reservoir = list()
+    for seen, tweet in enumerate(tweets):
+        if seen < size:
+            reservoir.append(tweet)
+        else:
+            index = rng.randrange(seen + 1)
+            if index < size:
+                reservoir[index] = tweet
+    rng.shuffle(reservoir)
+    return reservoir
+
 
 class SourceTracer:
 
@@ -324,71 +1739,194 @@ class SourceTracer:
         return self.word_sources.get(word, set())
 
 
-def noisify(tweet, iv, tokens):
-    tracer = SourceTracer()
+def context_window(tokens, index, replacements=None):
+    """
+    The --lm-context previous and next words around index, which are used to
+    score its candidates, and whether the window is cut off by the start or
+    the end of the tweet. Previous tokens are taken from replacements when
+    they are in there.
+    """
+    size = args.lm_context
+    previous_words = list()
+    for i in range(max(0, index-size), index):
+        previous_words.append(replacements.get(i, tokens[i]) if replacements else tokens[i])
+    next_words = tokens[index+1:index+1+size]
+    return ' '.join(previous_words), ' '.join(next_words), index < size, index + size >= len(tokens)
+
+
+def noisify_candidates(token, neighbours=None):
+    """
+    The (source, candidate) pairs of an IV token which do not depend on its
+    context. neighbours are its word embedding neighbours, if they were
+    looked up already.
+    """
+    candidates = list()
+    start = time.perf_counter()
+
+    # Brown cluster suggestions
+    brown_suggestions = noisy_clusters.suggest(token)
+    if brown_suggestions:
+        # Abbreviation suggestions (can be multiple)
+        best_abbreviations, score = noisy_clusters.abbreviations(token).best_matches_reverse(token, 0.7)
+        if score > 0.7:
+            candidates.extend(('Brown cluster (abbreviation)', abbreviation)
+                              for abbreviation in best_abbreviations)
+        # Most common IV token in cluster
+        most_common = noisy_clusters.most_common(clusters.get_path(token))
+        if most_common:
+            candidates.append(('Brown cluster (most common OOV)', most_common))
+    start = profiler.lap('noisify brown clusters', start)
+
+    # Word embedding suggestions
+    for possible_suggestion in embeddings.find(token) if neighbours is None else neighbours:
+        if possible_suggestion and not spelling.contains_word(possible_suggestion):
+            candidates.append(('word-embeddings', possible_suggestion))
+            break
+    start = profiler.lap('noisify embeddings', start)
+
+    # Split word
+    if args.allow_compounds:
+        for i in splitter.splits(token):
+            candidates.append(('word split', '{} {}'.format(token[:i], token[i:])))
+        profiler.lap('noisify word split', start)
+    return tuple(candidates)
+
+
+def clean_candidates(token, neighbours=None):
+    """
+    The typo suggestions of an OOV token, and the other (source, candidate)
+    pairs which do not depend on its context. neighbours are its word
+    embedding neighbours, if they were looked up already.
+    """
+    candidates = list()
+    start = time.perf_counter()
+
+    # typo suggestion
+    typo_suggestions = typos.suggest(token, 1)
+    if not typo_suggestions:
+        typo_suggestions = typos.suggest(token, 2)
+    start = profiler.lap('clean typo', start)
+
+    # Word embedding suggestions
+    for possible_suggestion in embeddings.find(token) if neighbours is None else neighbours:
+        if possible_suggestion and spelling.contains_word(possible_suggestion):
+            candidates.append(('word-embeddings', possible_suggestion))
+            break
+    start = profiler.lap('clean embeddings', start)
+
+    # Brown cluster suggestions
+    brown_suggestions = clusters.suggest(token)
+    if brown_suggestions:
+        # Abbreviation suggestions (can be multiple)
+        best_abbreviations, score = clusters.abbreviations(token).best_matches(token, 0.7)
+        if score > 0.7:
+            candidates.extend(('Brown cluster (abbreviation)', abbreviation)
+                              for abbreviation in best_abbreviations)
+        # Most common IV token in cluster
+        most_common = clusters.most_common(clusters.get_path(token))
+        if most_common:
+            candidates.append(('Brown cluster (most common IV)', most_common))
+    start = profiler.lap('clean brown clusters', start)
+
+    # Shorten (fix lengthening)
+    if len(token) > 3:
+        shortened = re.sub(r'(\w)\1+', r'\1\1', token)
+        if spelling.contains_word(shortened):
+            candidates.append(('shortening', shortened))
+        shortened = re.sub(r'(\w)\1+', r'\1', token)
+        if spelling.contains_word(shortened):
+            candidates.append(('shortening', shortened))
+        start = profiler.lap('clean shortening', start)
+
+    # Split word
+    if not args.allow_compounds:
+        for i in splitter.find_splits(token):
+            candidates.append(('word split', '{} {}'.format(token[:i], token[i:])))
+        profiler.lap('clean word split', start)
+    return tuple(typo_suggestions), tuple(candidates)
+
+
+def generate_candidates(keys):
+    """
+    The candidates of many (mode, token) keys, like clean_candidates and
+    noisify_candidates, with the word embedding neighbours of all tokens
+    looked up in one call.
+    """
+    neighbours = embeddings.find_many([token for _, token in keys])
+    return [(clean_candidates if mode == 'clean' else noisify_candidates)(token, [word for word, _ in pairs])
+            for (mode, token), pairs in zip(keys, neighbours)]
+
+
+def prepare_tweets(tweets):
+    """
+    Generates the candidates, and scores the language model windows, which
+    cleaning or noisifying the (mode, tokens, oov, iv) tweets needs, for all
+    of them at once; clean and noisify then find them in the caches. Only the
+    windows which are certainly scored are: those of all tokens to noisify,
+    and those of the first token to clean, as the context of the next ones
+    depends on its replacement.
+    """
+    start = time.perf_counter()
+    candidate_cache.fill([(mode, token)
+                          for mode, tokens, oov, iv in tweets
+                          for token in (oov if mode == 'clean' else iv).values()],
+                         generate_candidates)
+    start = profiler.lap('prepare candidates', start)
+    windows = list()
+    for mode, tokens, oov, iv in tweets:
+        if mode == 'noisify':
+            for index, token in iv.items():
+                previous_token, next_token, bos, eos = context_window(tokens, index)
+                suggestions = [suggestion for _, suggestion in candidate_cache.peek('noisify', token) or ()
+                               if suggestion[:1] != '#' and suggestion[:1] != '@']
+                windows.extend((previous_token, suggestion, next_token, bos, eos)
+                               for suggestion in [token] + suggestions)
+        elif mode == 'clean' and oov:
+            index, token = next(iter(oov.items()))
+            previous_token, next_token, bos, eos = context_window(tokens, index, oov)
+            typo_suggestions, candidates = candidate_cache.peek('clean', token) or ((), ())
+            suggestions = list(typo_suggestions) + [suggestion for _, suggestion in candidates]
+            windows.extend((previous_token, suggestion, next_token, bos, eos)
+                           for suggestion in [token] + suggestions)
+    lm_scores.score_many(windows)
+    profiler.lap('prepare scores', start)
+
+
+def noisify(tweet, iv, tokens, tracer=None):
+    if tracer is None:
+        tracer = SourceTracer()
     original = iv.copy()
     scores = dict()
     suggestion_log = dict()
     for index, token in iv.items():
         suggestions = set()
-        previous_token = tokens[index-1] if index > 0 else ''
-        next_token = tokens[index+1] if index+1 < len(tokens) else ''
-
-        # Brown cluster suggestions
-        brown_suggestions = noisy_clusters.suggest(token)
-        if brown_suggestions:
-            # Abbreviation suggestions (can be multiple)
-            best_abbreviations, score = Scorer.abbreviation_best_matches_reverse(
-                    token,
-                    brown_suggestions)
-            if score > 0.7:
-                suggestions |= best_abbreviations
-                tracer.add_trace('Brown cluster (abbreviation)', index, *best_abbreviations)
-            # Most common IV token in cluster
-            most_common = noisy_clusters.most_common(clusters.get_path(token))
-            if most_common:
-                suggestions.add(most_common)
-                tracer.add_trace('Brown cluster (most common OOV)', index, most_common)
-
-        # Word embedding suggestions
-        for possible_suggestion in embeddings.find(token):
-            if possible_suggestion and not spelling.contains_word(possible_suggestion):
-                suggestions.add(possible_suggestion)
-                tracer.add_trace('word-embeddings', index, possible_suggestion)
-                break
+        previous_token, next_token, bos, eos = context_window(tokens, index)
 
-        # Split word
-        if args.allow_compounds:
-            word_combination = None
-            for i in range(2, len(token)-2):
-                if spelling.contains_word(token[:i]) \
-                        and spelling.contains_word(token[i:]):
-                    phrase = '{} {}'.format(token[:i], token[i:])
-                    suggestions.add(phrase)
-                    tracer.add_trace('word split', index, phrase)
+        for source, suggestion in candidate_cache.candidates('noisify', token, noisify_candidates):
+            suggestions.add(suggestion)
+            tracer.add_trace(source, index, suggestion)
+        start = time.perf_counter()
 
         # Select candidate, and filter some illegal matches, such as hashtags
         best_suggestion = token
-        best_score = language_model.score('{} {} {}'.format(
-                previous_token, token, next_token),
-                bos=(previous_token == ''),
-                eos=(next_token == '')) * 2
+        best_score = lm_scores.score(previous_token, token, next_token, bos, eos) * 2
         for suggestion in suggestions:
             if suggestion[:1] == '#' or suggestion[:1] == '@':
                 continue
-            score = language_model.score('{} {} {}'.format(
-                    previous_token, suggestion, next_token),
-                    bos=(previous_token == ''),
-                    eos=(next_token == ''))
+            score = lm_scores.score(previous_token, suggestion, next_token, bos, eos)
             if score > best_score:
                 best_score = score
                 best_suggestion = suggestion
+        profiler.lap('noisify selection', start)
         if best_suggestion != token and len(tracer.get_sources(index, best_suggestion)) >= 2:
             iv[index] = best_suggestion
             scores[index] = best_score
             suggestion_log[index] = suggestions
+        elif best_suggestion != token:
+            profiler.count('noisify rejections (single source)')
     if iv == original:
         return
+    start = time.perf_counter()
 
     # Write output
     noisyfied = list()
@@ -397,13 +1935,18 @@ def noisify(tweet, iv, tokens):
             noisyfied.append(iv[index])
         else:
             noisyfied.append(token)
-    for original_token, noisyfied_token in zip(tokens, noisyfied):
-        change = 'IV' if original_token == noisyfied_token else 'OOV'
-        out_clean.writeTokenPair(noisyfied_token, original_token, change)
+    for index, (original_token, noisyfied_token) in enumerate(zip(tokens, noisyfied)):
+        if original_token == noisyfied_token:
+            out_clean.writeTokenPair(noisyfied_token, original_token, 'IV')
+        else:
+            out_clean.writeTokenPair(noisyfied_token, original_token, 'OOV')
     out_clean.newline()
 
     # Calculate probability, as a sort of confidence score
-    sentence_probability = language_model.score(' '.join(noisyfied), bos=True, eos=True)
+    sentence_probability = lm_scores.sentence_score(noisyfied)
+    profiler.count('sentence scores')
+    profiler.lap('noisify output', start)
+    profiler.count('tweets noisified')
 
     # print debug info
     if args.debug:
@@ -427,92 +1970,53 @@ def noisify(tweet, iv, tokens):
     return sentence_probability
 
 
-def clean(tweet, oov, tokens):
-    tracer = SourceTracer()
+def clean(tweet, oov, tokens, tracer=None):
+    if tracer is None:
+        tracer = SourceTracer()
     original = oov.copy()
     scores = dict()
     suggestion_log = dict()
     for index, token in oov.items():
         suggestions = set()
-        previous_token = tokens[index-1] if index > 0 else ''
-        next_token = tokens[index+1] if index+1 < len(tokens) else ''
-        if index-1 in oov:  # If the previous token has been normalized, use the replacement
-            previous_token = oov[index-1]
+        # If previous tokens have been normalized, the replacements are used
+        previous_token, next_token, bos, eos = context_window(tokens, index, oov)
 
         # typo suggestion
-        typo_suggestions = spelling.suggest(token, 1)
-        if not typo_suggestions:
-            typo_suggestions = spelling.suggest(token, 2)
+        typo_suggestions, candidates = candidate_cache.candidates('clean', token, clean_candidates)
+        start = time.perf_counter()
         if typo_suggestions:
             best_match, score = distance_scorer.best_match(token,
                                                            typo_suggestions,
                                                            previous_token,
-                                                           next_token)
+                                                           next_token,
+                                                           bos,
+                                                           eos)
             suggestions.add(best_match)
             tracer.add_trace('typo', index, best_match)
+        start = profiler.lap('clean typo best match', start)
 
-        # Word embedding suggestions
-        for possible_suggestion in embeddings.find(token):
-            if possible_suggestion and spelling.contains_word(possible_suggestion):
-                suggestions.add(possible_suggestion)
-                tracer.add_trace('word-embeddings', index, possible_suggestion)
-                break
-
-        # Brown cluster suggestions
-        brown_suggestions = clusters.suggest(token)
-        if brown_suggestions:
-            # Abbreviation suggestions (can be multiple)
-            best_abbreviations, score = Scorer.abbreviation_best_matches(token, brown_suggestions)
-            if score > 0.7:
-                suggestions |= best_abbreviations
-                tracer.add_trace('Brown cluster (abbreviation)', index, *best_abbreviations)
-            # Most common IV token in cluster
-            most_common = clusters.most_common(clusters.get_path(token))
-            if most_common:
-                suggestions.add(most_common)
-                tracer.add_trace('Brown cluster (most common IV)', index, most_common)
-
-        # Shorten (fix lengthening)
-        if len(token) > 3:
-            shortened = re.sub(r'(\w)\1+', r'\1\1', token)
-            if spelling.contains_word(shortened):
-                suggestions.add(shortened)
-                tracer.add_trace('shortening', index, shortened)
-            shortened = re.sub(r'(\w)\1+', r'\1', token)
-            if spelling.contains_word(shortened):
-                suggestions.add(shortened)
-                tracer.add_trace('shortening', index, shortened)
-
-        # Split word
-        if not args.allow_compounds:
-            word_combination = None
-            for i in range(2, len(token)-2):
-                if spelling.contains_word(token[:i]) \
-                        and spelling.contains_word(token[i:]):
-                    phrase = '{} {}'.format(token[:i], token[i:])
-                    suggestions.add(phrase)
-                    tracer.add_trace('word split', index, phrase)
+        for source, suggestion in candidates:
+            suggestions.add(suggestion)
+            tracer.add_trace(source, index, suggestion)
 
         # Select candidate
         best_suggestion = token
-        best_score = language_model.score('{} {} {}'.format(
-                previous_token, token, next_token),
-                bos=(previous_token == ''),
-                eos=(next_token == ''))
+        best_score = lm_scores.score(previous_token, token, next_token, bos, eos)
         for suggestion in suggestions:
-            score = language_model.score('{} {} {}'.format(
-                    previous_token, suggestion, next_token),
-                    bos=(previous_token == ''),
-                    eos=(next_token == ''))
+            score = lm_scores.score(previous_token, suggestion, next_token, bos, eos)
             if score > best_score:
                 best_score = score
                 best_suggestion = suggestion
+        profiler.lap('clean selection', start)
         if best_suggestion != token and len(tracer.get_sources(index, best_suggestion)) >= 2:
             oov[index] = best_suggestion
             scores[index] = best_score
             suggestion_log[index] = suggestions
         else:
+            if best_suggestion != token:
+                profiler.count('clean rejections (single source)')
             return 0
+    start = time.perf_counter()
 
     # Write output
     cleaned = list()
@@ -521,13 +2025,18 @@ def clean(tweet, oov, tokens):
             cleaned.append(oov[index])
         else:
             cleaned.append(token)
-    for original_token, cleaned_token in zip(tokens, cleaned):
-        change = 'IV' if original_token == cleaned_token else 'OOV'
-        out_noisy.writeTokenPair(original_token, cleaned_token, change)
+    for index, (original_token, cleaned_token) in enumerate(zip(tokens, cleaned)):
+        if original_token == cleaned_token:
+            out_noisy.writeTokenPair(original_token, cleaned_token, 'IV')
+        else:
+            out_noisy.writeTokenPair(original_token, cleaned_token, 'OOV')
     out_noisy.newline()
 
     # Calculate probability, as a sort of confidence score
-    sentence_probability = language_model.score(' '.join(cleaned), bos=True, eos=True)
+    sentence_probability = lm_scores.sentence_score(cleaned)
+    profiler.count('sentence scores')
+    profiler.lap('clean output', start)
+    profiler.count('tweets cleaned')
 
     # print debug info
     if args.debug:
@@ -552,50 +2061,490 @@ def clean(tweet, oov, tokens):
     return sentence_probability
 
 
+def is_truncated(tweet):
+    tokens = tweet.split()
+    return bool(tokens) and (tokens[-1] == '…' or tokens[-1] == ['...'])
+
+
+def tokenize_tweet(tweet):
+    """The preprocessed tokens of a tweet, or None for truncated tweets."""
+    if is_truncated(tweet):
+        return None
+    return Preprocessor.preprocess_line(tweet)
+
+
+def classify_tokens(tokens):
+    """The OOV and IV tokens of a tweet which can be normalized, by their index."""
+    oov = dict()
+    iv = dict()
+    for index, token in enumerate(tokens):
+        # Non-words, emoticons, emoji, etc
+        if not re.search(r'[a-zA-Z]', token) or Preprocessor.is_emoticon(token):
+            continue
+        # Users, hashtags, urls
+        if re.match(r"<[UR]>", token) or token[:1] == '#' or token[:1] == '@' or 'http' in token:
+            continue
+        # Names
+        if index != 0 and len(token) >= 2 and token[0].isupper() and not token[1].isupper():
+            continue
+        # Compound words
+        if args.allow_compounds and splitter.splits(token):
+            continue
+        # OOV tokens
+        if not spelling.contains_word(token):
+            oov[index] = token
+        else:
+            iv[index] = token
+    return oov, iv
+
+
+def process_tweet(tweet, tokens=None, clean_wanted=True, noisify_wanted=True):
+    """
+    Cleans or noisifies a tweet. tokens are its preprocessed tokens, when the
+    tweet was already tokenized with tokenize_tweet. Tweets of a kind which is
+    not wanted are left alone.
+    """
+    profiler.count('tweets')
+    start = time.perf_counter()
+    if tokens is None:
+        tokens = tokenize_tweet(tweet)
+        if tokens is None:
+            return
+    oov, iv = classify_tokens(tokens)
+    profiler.lap('preprocessing', start)
+    profiler.count('OOV tokens', len(oov))
+    profiler.count('IV tokens', len(iv))
+    if len(oov) == 0:
+        if noisify_wanted:
+            noisify(tweet, iv, tokens)
+    elif clean_wanted:
+        score = clean(tweet, oov, tokens)
+
+
+def select_tweets():
+    """
+    The (input file index, tweet, tokens) triples to process: the (unique)
+    tweets of the input in order, or the --sample of them. The tokens are
+    those found while deduplicating, None when the tweet is not tokenized yet.
+    """
+    if deduplicator:
+        tweets = ((input_file.position[0], tweet, tokens) for tweet, tokens in deduplicator.unique(input_file))
+    else:
+        tweets = ((input_file.position[0], tweet, None) for tweet in input_file)
+    if args.sample == 'stride':
+        return stride_sample(tweets, args.sample_size, count_tweets(args.data, args.readers))
+    if args.sample == 'reservoir':
+        return reservoir_sample(tweets, args.sample_size, random.Random(args.sample_seed))
+    return tweets
+
+
 def main(args):
     print('Processing', file=sys.stderr)
-    for tweet in input_file:
-        tokens = tweet.split()
-        if tokens and (tokens[-1] == '…' or tokens[-1] == ['...']):
-             continue
-        oov = dict()
-        iv = dict()
-        tokens = Preprocessor.preprocess(tokens)
-        for index, token in enumerate(tokens):
-            # Non-words, emoticons, emoji, etc
-            if not re.search(r'[a-zA-Z]', token) or Preprocessor.is_emoticon(token):
-                continue
-            # Users, hashtags, urls
-            if re.match(r"<[UR]>", token) or token[:1] == '#' or token[:1] == '@' or 'http' in token:
+    statistics = Counter()
+    for source, tweet, tokens in select_tweets():
+        if quota:
+            quota.finish_before(source)
+            clean_wanted, noisify_wanted = quota.wants(source)
+            if not (clean_wanted or noisify_wanted):
                 continue
-            # Names
-            if index != 0 and len(token) >= 2 and token[0].isupper() and not token[1].isupper():
-                continue
-            # Compound words
-            if args.allow_compounds:
-                compound = False
-                for i in range(2, len(token)-2):
-                    if spelling.contains_word(token[:i]) and spelling.contains_word(token[i:]):
-                        compound = True
-                        break
-                if compound:
-                    continue
-            # OOV tokens
-            if not spelling.contains_word(token):
-                oov[index] = token
+            cleaned, noisified = out_noisy.tweets, out_clean.tweets
+            process_tweet(tweet, tokens, clean_wanted, noisify_wanted)
+            quota.add(source, out_noisy.tweets - cleaned, out_clean.tweets - noisified)
+        else:
+            process_tweet(tweet, tokens)
+        if checkpoint and checkpoint.due():
+            checkpoint.save(input_file.position)
+        if profile and profile.due():
+            statistics.update(take_statistics())
+            profile.save(statistics)
+        if quota and quota.done():
+            break
+    if checkpoint:
+        checkpoint.save(input_file.position)
+    if quota:
+        quota.report(args.data)
+    if args.candidate_cache:
+        save_candidate_cache(args.candidate_cache)
+    statistics.update(take_statistics())
+    if deduplicator:
+        statistics.update(deduplicator.take_statistics())
+    if profile:
+        profile.save(statistics)
+    report_statistics(statistics)
+
+
+def load_vocabulary(path, index_path=None, reverse=False):
+    """
+    Builds the SuggestionTree of a vocabulary file. If index_path is given, the
+    tree is memory-mapped from that binary index instead, which is (re)built
+    first when it is missing or older than the vocabulary. With reverse, the
+    tree contains the lower cased words spelled backwards.
+    """
+    if index_path and os.path.exists(index_path) \
+            and os.path.getmtime(index_path) >= os.path.getmtime(path):
+        return CompactSuggestionTree.load(index_path)
+    spelling = SuggestionTree(ignore_case=not reverse)
+    with open(path, 'r', encoding='utf-8', newline='\n') as f:
+        for line in f:
+            if reverse:
+                spelling.add_word(line.rstrip().lower()[::-1])
             else:
-                iv[index] = token
-        if len(oov) == 0:
-            noisify(tweet, iv, tokens)
+                spelling.add_word(line.rstrip())
+    if not index_path:
+        return spelling
+    print('Saving vocabulary index: {}'.format(index_path), file=sys.stderr)
+    CompactSuggestionTree.from_tree(spelling).save(index_path)
+    return CompactSuggestionTree.load(index_path)
+
+
+def load_compound_splitter(path, spelling, index_path=None):
+    """The CompoundSplitter, with its reversed vocabulary index next to index_path (.reversed)."""
+    reversed_index_path = index_path + '.reversed' if index_path else None
+    reversed_vocabulary = load_vocabulary(path, reversed_index_path, reverse=True)
+    return CompoundSplitter(Deferred.resolve(spelling), reversed_vocabulary)
+
+
+def load_deletion_index(path):
+    typos = DeletionIndex(ignore_case=True)
+    with open(path, 'r', encoding='utf-8', newline='\n') as f:
+        for line in f:
+            typos.add_word(line.rstrip())
+    return typos
+
+
+def load_brown_clusters(paths, vocabulary, spelling, snapshot_path=None):
+    """
+    Builds the Brown cluster index, or loads it from snapshot_path if that
+    snapshot was made from the same paths and vocabulary files.
+    """
+    fingerprint = BrownClusterIndex.fingerprint_of(paths, vocabulary)
+    if snapshot_path and os.path.exists(snapshot_path):
+        index = BrownClusterIndex.load(snapshot_path)
+        if index.fingerprint == fingerprint:
+            return index
+    index = BrownClusterIndex.build(paths, spelling)
+    index.fingerprint = fingerprint
+    if snapshot_path:
+        print('Saving Brown cluster snapshot: {}'.format(snapshot_path), file=sys.stderr)
+        index.save(snapshot_path)
+    return index
+
+
+class Deferred:
+    """
+    Placeholder for a global resource which is loaded on a background thread.
+    The thread replaces the global by the resource once it is loaded; until
+    then, using the placeholder waits for it.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.ready = threading.Event()
+        self.value = None
+        self.error = None
+
+    def get(self):
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def __getattr__(self, attribute):
+        return getattr(self.get(), attribute)
+
+    @staticmethod
+    def resolve(value):
+        """Waits for value if it is a placeholder, for resources which keep a reference to it."""
+        return value.get() if isinstance(value, Deferred) else value
+
+
+def load_in_background(label, names, load, *load_args):
+    """
+    Sets the globals names to placeholders, and starts a thread which sets
+    them to the resources returned by load(*load_args): a tuple, or a single
+    resource for a single name.
+    """
+    placeholders = [Deferred(name) for name in names]
+    globals().update(zip(names, placeholders))
+
+    def run():
+        start = time.perf_counter()
+        try:
+            values = load(*load_args)
+            if len(names) == 1:
+                values = (values,)
+        except BaseException as error:
+            print('Loading {} failed: {}'.format(label, error), file=sys.stderr)
+            values = [None] * len(names)
+            for placeholder in placeholders:
+                placeholder.error = error
         else:
-            score = clean(tweet, oov, tokens)
+            globals().update(zip(names, values))
+            print('Loaded {} in {:.1f}s'.format(label, time.perf_counter() - start), file=sys.stderr)
+        for placeholder, value in zip(placeholders, values):
+            placeholder.value = value
+            placeholder.ready.set()
 
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--data',
-                        help='The file containing tweets',
-                        required=True)
+
+def load_language_model(path, score_cache_size):
+    if kenlm is None:
+        raise ImportError('Loading a language model requires the kenlm package')
+    language_model = kenlm.Model(path)
+    lm_scores = ScoreCache(language_model, score_cache_size)
+    return language_model, lm_scores, Scorer(lm_scores)
+
+
+def neighbour_index_path(args):
+    """The neighbour index next to the embeddings cache, if it is used."""
+    path = args.embeddings + '.ann'
+    return path if args.w2v and os.path.exists(path) else None
+
+
+def load_embeddings(path, mmap, w2v=None, index_path=None, search_k=0):
+    # Imported here, so the rest of this module works without the compiled library
+    from embeddings import Embeds
+    embeddings = Embeds()
+    if w2v:
+        # Searched for the words which are missing from the cache
+        embeddings.loadW2V(w2v)
+        if index_path and embeddings.loadIndex(index_path):
+            embeddings.setSearchK(search_k)
+    embeddings.loadBin(path, mmap=mmap)
+    return embeddings
+
+
+def load_typos(args, spelling):
+    if args.typo_candidates == 'deletions':
+        return load_deletion_index(args.vocabulary)
+    return Deferred.resolve(spelling)
+
+
+def load_clusters(args, spelling):
+    cluster_index = load_brown_clusters(args.paths, args.vocabulary, spelling, args.clusters_snapshot)
+    return cluster_index.view(force_oov=False), cluster_index.view(force_oov=True)
+
+
+def load_candidate_cache(args):
+    candidate_cache = CandidateCache(args.candidate_cache_size,
+                                     (BrownClusterIndex.fingerprint_of(args.vocabulary, args.paths, args.embeddings),
+                                      args.w2v and BrownClusterIndex.fingerprint_of(args.w2v),
+                                      neighbour_index_path(args) and BrownClusterIndex.fingerprint_of(
+                                          neighbour_index_path(args)) + (args.ann_search_k,),
+                                      args.typo_candidates,
+                                      args.allow_compounds))
+    if args.candidate_cache and os.path.exists(args.candidate_cache):
+        if not candidate_cache.load(args.candidate_cache):
+            print('Ignoring candidate cache made with other resources: {}'.format(args.candidate_cache),
+                  file=sys.stderr)
+    return candidate_cache
+
+
+def load_resources(args):
+    """
+    Starts loading all resources concurrently. Processing can start right
+    away, and waits for the resources which are not loaded yet when they
+    are used.
+    """
+    global profiler
+    print('Initializing', file=sys.stderr)
+    profiler = Profiler()
+    load_in_background('language model', ('language_model', 'lm_scores', 'distance_scorer'),
+                       load_language_model, args.model, args.score_cache_size)
+    load_in_background('embeddings', ('embeddings',),
+                       load_embeddings, args.embeddings, args.embeddings_mmap,
+                       args.w2v, neighbour_index_path(args), args.ann_search_k)
+    load_in_background('vocabulary', ('spelling',),
+                       load_vocabulary, args.vocabulary, args.vocabulary_index)
+    # These wait for the vocabulary when they need it
+    load_in_background('compound splitter', ('splitter',),
+                       load_compound_splitter, args.vocabulary, spelling, args.vocabulary_index)
+    load_in_background('typo candidates', ('typos',),
+                       load_typos, args, spelling)
+    load_in_background('Brown clusters', ('clusters', 'noisy_clusters'),
+                       load_clusters, args, spelling)
+    load_in_background('candidate cache', ('candidate_cache',),
+                       load_candidate_cache, args)
+
+
+def prepare_indexes(args):
+    """
+    Builds the index files which are missing or outdated, before the worker
+    processes start, so the workers only map them instead of all building
+    and writing them at once.
+    """
+    if args.vocabulary_index or args.clusters_snapshot:
+        spelling = load_vocabulary(args.vocabulary, args.vocabulary_index)
+    if args.vocabulary_index:
+        load_compound_splitter(args.vocabulary, spelling, args.vocabulary_index)
+    if args.clusters_snapshot:
+        load_brown_clusters(args.paths, args.vocabulary, spelling, args.clusters_snapshot)
+
+
+def init_worker(worker_args):
+    global args, out_noisy, out_clean
+    args = worker_args
+    load_resources(args)
+    out_noisy = BufferWriter()
+    out_clean = BufferWriter()
+
+
+def process_chunk(tweets, wanted=None, tokens=None):
+    """
+    Processes a chunk of tweets in a worker, with their tokens if they were
+    tokenized already. With wanted, the (clean, noisify) flags of every tweet,
+    the output of every tweet is returned separately.
+    """
+    if tokens is None:
+        tokens = [None] * len(tweets)
+    if wanted is None:
+        for tweet, tweet_tokens in zip(tweets, tokens):
+            process_tweet(tweet, tweet_tokens)
+        return out_noisy.take(), out_clean.take(), take_statistics()
+    noisy = list()
+    clean = list()
+    for tweet, tweet_tokens, (clean_wanted, noisify_wanted) in zip(tweets, tokens, wanted):
+        process_tweet(tweet, tweet_tokens, clean_wanted, noisify_wanted)
+        noisy.append(out_noisy.take())
+        clean.append(out_clean.take())
+    return noisy, clean, take_statistics()
+
+
+def take_statistics():
+    """Collects the counters of this process since the previous call."""
+    statistics = profiler.take_statistics()
+    for name, value in lm_scores.cache.take_statistics().items():
+        statistics['score cache ' + name] += value
+    for name, value in lm_scores.ngrams.take_statistics().items():
+        statistics['n-gram cache ' + name] += value
+    for name, value in candidate_cache.cache.take_statistics().items():
+        statistics['candidate cache ' + name] += value
+    for name, value in splitter.cache.take_statistics().items():
+        statistics['split cache ' + name] += value
+    return statistics
+
+
+def report_statistics(statistics):
+    if deduplicator:
+        print('Skipped {} duplicate tweets'.format(statistics['duplicate tweets']), file=sys.stderr)
+        if isinstance(deduplicator.seen, BloomFilter):
+            print('Estimated false positive rate of the duplicate filter: {:.2%}'.format(
+                    deduplicator.seen.false_positive_rate()),
+                  file=sys.stderr)
+    for cache in ('score cache', 'n-gram cache', 'candidate cache', 'split cache'):
+        hits = statistics[cache + ' hits']
+        misses = statistics[cache + ' misses']
+        if cache == 'split cache' and not hits + misses:
+            # Only used with --allow-compounds
+            continue
+        print('{}: {} hits, {} misses ({:.1%} hit rate), {} evictions'.format(
+                cache.capitalize(),
+                hits,
+                misses,
+                hits / (hits + misses) if hits + misses else 0,
+                statistics[cache + ' evictions']),
+              file=sys.stderr)
+
+
+def save_candidate_cache(path):
+    print('Saving candidate cache: {}'.format(path), file=sys.stderr)
+    candidate_cache.save(path)
+
+
+def chunks(lines, size):
+    lines = iter(lines)
+    while True:
+        chunk = list(itertools.islice(lines, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def main_parallel(args, pool):
+    """
+    Distributes the input over the worker processes of the pool (started
+    with init_worker) in chunks of tweets. The
+    results are written in input order, so the output is identical to a
+    single process run. With a quota, the results are checked against it
+    tweet by tweet when they are written, as the workers only know which
+    kinds were still wanted when their chunk was sent. Once the quota is
+    met, the rest of the results are dropped, where a single process run
+    stops.
+    """
+    print('Processing ({} workers)'.format(args.workers), file=sys.stderr)
+    with pool:
+        # Only keep a few chunks per worker in flight to bound memory usage
+        pending = deque()
+        statistics = Counter()
+
+        def write_result():
+            result, position, sources = pending.popleft()
+            noisy, clean, chunk_statistics = result.get()
+            if quota:
+                for source, noisy_tweet, clean_tweet in zip(sources, noisy, clean):
+                    if quota.done():
+                        break
+                    quota.finish_before(source)
+                    clean_wanted, noisify_wanted = quota.wants(source)
+                    cleaned = bool(noisy_tweet) and clean_wanted
+                    noisified = bool(clean_tweet) and noisify_wanted
+                    if cleaned:
+                        out_noisy.write(noisy_tweet)
+                    if noisified:
+                        out_clean.write(clean_tweet)
+                    quota.add(source, cleaned, noisified)
+            else:
+                out_noisy.write(noisy)
+                out_clean.write(clean)
+            statistics.update(chunk_statistics)
+            if quota and quota.done():
+                # The chunks still in flight hold tweets after the one which met the quota
+                pending.clear()
+            # Only positions of chunks that have been written can be resumed from. The
+            # duplicate filter has seen the tweets of all chunks sent, so with one, only
+            # the position of the last chunk sent matches it.
+            if checkpoint and (not pending or (checkpoint.due() and not deduplicator)):
+                checkpoint.save(position)
+            if profile and profile.due():
+                profile.save(statistics)
+
+        for chunk in chunks(select_tweets(), args.chunk_size):
+            wanted = None
+            if quota:
+                wanted = [quota.may_want(source) for source, _, _ in chunk]
+                chunk = [item for item, flags in zip(chunk, wanted) if any(flags)]
+                wanted = [flags for flags in wanted if any(flags)]
+            sources = [source for source, _, _ in chunk]
+            tweets = [tweet for _, tweet, _ in chunk]
+            # The tokens found while deduplicating are sent along, instead of tokenizing again
+            tokens = [tweet_tokens for _, _, tweet_tokens in chunk] if deduplicator else None
+            pending.append((pool.apply_async(process_chunk, (tweets, wanted, tokens)), input_file.position, sources))
+            if len(pending) >= 2 * args.workers:
+                write_result()
+            if checkpoint and deduplicator and checkpoint.due():
+                while pending:
+                    write_result()
+            if quota and quota.done():
+                break
+        while pending:
+            write_result()
+        if args.candidate_cache:
+            # The workers' caches hold much the same tokens, the one of any worker is kept
+            pool.apply(save_candidate_cache, (args.candidate_cache,))
+    if deduplicator:
+        statistics.update(deduplicator.take_statistics())
+    if profile:
+        profile.save(statistics)
+    if quota:
+        quota.report(args.data)
+    report_statistics(statistics)
+
+
+def add_resource_arguments(parser):
+    """Adds the arguments which select and configure the resources used by load_resources."""
     parser.add_argument('--vocabulary',
                         help='A list containing IV words',
                         required=True)
@@ -611,6 +2560,48 @@ if __name__ == '__main__':
     parser.add_argument('--allow-compounds',
                         action='store_true',
                         help='Allows words to be chained together without a space')
+    parser.add_argument('--embeddings-mmap',
+                        action='store_true',
+                        help='Memory-map the cached embeddings instead of loading them, shared between workers')
+    parser.add_argument('--w2v',
+                        help='Binary word2vec model, to find the neighbours of words missing from the embeddings cache')
+    parser.add_argument('--ann-search-k',
+                        type=int,
+                        default=0,
+                        help='Number of words compared with a missing word in the neighbour index next to the '
+                             'embeddings cache (<embeddings>.ann); higher is slower but closer to exact search')
+    parser.add_argument('--vocabulary-index',
+                        help='Binary vocabulary index, memory-mapped instead of building the vocabulary tree (created if missing)')
+    parser.add_argument('--typo-candidates',
+                        choices=['tree', 'deletions'],
+                        default='tree',
+                        help='Generate typo candidates by walking the vocabulary tree, or from a precomputed deletion index')
+    parser.add_argument('--clusters-snapshot',
+                        help='Binary snapshot of the Brown clusters, used instead of parsing the paths file (created if missing or outdated)')
+    parser.add_argument('--score-cache-size',
+                        type=int,
+                        default=500000,
+                        help='Number of language model scores to keep in memory per process (0 disables the cache)')
+    parser.add_argument('--lm-context',
+                        type=int,
+                        default=1,
+                        help='Number of words before and after a token used to score its candidates '
+                             '(at most the order of the language model minus 1)')
+    parser.add_argument('--candidate-cache-size',
+                        type=int,
+                        default=100000,
+                        help='Number of tokens of which the candidates are kept in memory per process (0 disables the cache)')
+    parser.add_argument('--candidate-cache',
+                        help='Load the candidate cache from this file when it exists, and save it at the end of the run')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    add_resource_arguments(parser)
+    parser.add_argument('--data',
+                        nargs='+',
+                        help='The files containing tweets, either one tweet per line or gzipped Twitter JSON (.json.gz)',
+                        required=True)
     parser.add_argument('--output-clean',
                         help='The file to write noisified token pairs to',
                         required=True)
@@ -621,17 +2612,118 @@ if __name__ == '__main__':
                         action='store_true',
                         help='Print debug information',
                         required=False)
+    parser.add_argument('--readers',
+                        type=int,
+                        default=2,
+                        help='Number of input files read and decompressed ahead in background threads')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='Number of worker processes used for generation')
+    parser.add_argument('--chunk-size',
+                        type=int,
+                        default=1000,
+                        help='Number of tweets sent to a worker at once')
+    parser.add_argument('--checkpoint',
+                        help='Regularly record the progress of the run in this file')
+    parser.add_argument('--checkpoint-interval',
+                        type=float,
+                        default=300,
+                        help='Number of seconds between checkpoints')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='Continue an interrupted run from its --checkpoint')
+    parser.add_argument('--dedup',
+                        action='store_true',
+                        help='Skip tweets which are the same as an earlier tweet, apart from case, users and urls')
+    parser.add_argument('--dedup-memory',
+                        type=float,
+                        help='Skip duplicates using a Bloom filter of this many MB instead of keeping all hashes '
+                             '(implies --dedup)')
+    parser.add_argument('--profile',
+                        help='Regularly write the time spent per stage and other counters to this JSON file')
+    parser.add_argument('--profile-interval',
+                        type=float,
+                        default=60,
+                        help='Number of seconds between updates of the --profile report')
+    parser.add_argument('--target-clean',
+                        type=int,
+                        help='Stop once this many tweets have been cleaned, and any --target-noisy is met')
+    parser.add_argument('--target-noisy',
+                        type=int,
+                        help='Stop once this many tweets have been noisified, and any --target-clean is met')
+    parser.add_argument('--balance-sources',
+                        action='store_true',
+                        help='Split the targets evenly over the --data files')
+    parser.add_argument('--sample',
+                        choices=['stride', 'reservoir'],
+                        help='Process a sample of --sample-size tweets spread over the whole input: every k-th tweet '
+                             '(stride, which counts the input first), or a uniform random sample in random order '
+                             '(reservoir, kept in memory)')
+    parser.add_argument('--sample-size',
+                        type=int,
+                        help='Number of tweets in the --sample')
+    parser.add_argument('--sample-seed',
+                        type=int,
+                        default=1,
+                        help='Seed of the reservoir sample')
     args = parser.parse_args()
-    spelling = SuggestionTree(ignore_case=True)
-    language_model = kenlm.Model(args.model)
-    distance_scorer = Scorer(language_model)
-    embeddings = Embeds()
-    embeddings.loadBin(args.embeddings)
-    print('Initializing', file=sys.stderr)
-    with open(args.vocabulary, 'r', encoding='utf-8', newline='\n') as f:
-        for line in f:
-            spelling.add_word(line.rstrip())
-    clusters = BrownClusters(args.paths, spelling, force_oov=False)
-    noisy_clusters = BrownClusters(args.paths, spelling, force_oov=True)
-    with open(args.data, 'r', encoding='utf-8', newline='\n') as input_file, Writer(args.output_noisy) as out_noisy, Writer(args.output_clean) as out_clean:
-        main(args)
+    if args.workers > 1 and args.debug:
+        parser.error('--debug can only be used with a single worker')
+    if args.lm_context < 1:
+        parser.error('--lm-context must be at least 1')
+    if args.resume and not args.checkpoint:
+        parser.error('--resume requires --checkpoint')
+    if any(target is not None and target < 0 for target in (args.target_clean, args.target_noisy)):
+        parser.error('the targets cannot be negative')
+    if args.balance_sources and args.target_clean is None and args.target_noisy is None:
+        parser.error('--balance-sources requires --target-clean or --target-noisy')
+    if args.sample and not args.sample_size:
+        parser.error('--sample requires --sample-size')
+    if args.sample and args.checkpoint:
+        parser.error('--sample cannot be combined with --checkpoint')
+    state = None
+    if args.resume:
+        try:
+            state = Checkpoint.load(args.checkpoint, args.data)
+        except ValueError as e:
+            parser.error(str(e))
+        if state is None:
+            print('No checkpoint found at {}, starting from the beginning'.format(args.checkpoint), file=sys.stderr)
+        else:
+            print('Resuming from {} tweets into {}'.format(state['position'][1], args.data[state['position'][0]]
+                  if state['position'][0] < len(args.data) else 'the end'), file=sys.stderr)
+    deduplicator = None
+    if args.dedup or args.dedup_memory:
+        deduplicator = Deduplicator(int(args.dedup_memory * 1024 * 1024) if args.dedup_memory else None)
+        if state and state.get('dedup'):
+            try:
+                deduplicator.load(state['dedup'])
+            except (OSError, ValueError) as e:
+                parser.error(str(e))
+    quota = None
+    if args.target_clean is not None or args.target_noisy is not None:
+        try:
+            quota = Quota(args.target_clean, args.target_noisy, len(args.data), args.balance_sources,
+                          sequential=args.sample != 'reservoir', counts=state and state.get('quota'))
+        except ValueError as e:
+            parser.error(str(e))
+    if args.workers <= 1:
+        load_resources(args)
+    else:
+        prepare_indexes(args)
+        # Forked before any thread is started, as the writers and readers do, so no
+        # worker can inherit a lock held by one of those threads
+        pool = multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(args,))
+    input_file = InputReader(args.data, args.readers, start=state and state['position'])
+    resume_noisy, resume_clean = state['outputs'] if state else (None, None)
+    with Writer(args.output_noisy, resume_noisy) as out_noisy, Writer(args.output_clean, resume_clean) as out_clean:
+        checkpoint = None
+        if args.checkpoint:
+            checkpoint = Checkpoint(args.checkpoint, args.data, (out_noisy, out_clean), args.checkpoint_interval,
+                                    quota, deduplicator, state)
+        profile = ProfileReport(args.profile, args.profile_interval) if args.profile else None
+        if args.workers > 1:
+            main_parallel(args, pool)
+        else:
+            main(args)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Runs several generate.py configurations (jobs) from a JSON job file, for
+example all languages and vocabulary variants of a refresh:
+
+    {
+        "workers": 4,
+        "memory": "60G",
+        "jobs": [
+            {"name": "en", "data": ["tweets/en.txt"], "memory": "12G",
+             "vocabulary": "vocabularies/en", "paths": "clusters/en/paths", "model": "lms/en.bin",
+             "embeddings": "en.cached.bin", "output_noisy": "en.noisy", "output_clean": "en.clean",
+             "allow_compounds": true},
+            ...
+        ]
+    }
+
+Every job runs in its own process, which loads its own resources, and its
+memory (address space) is limited to its budget. Jobs are started as long as
+there are free workers and their budgets fit in the total memory. Jobs with
+the same input are started together where possible: the input is then read
+and tokenized once, and the tweets are sent to all of those jobs. A group of
+jobs which does not fit the workers or the total memory is split, and its
+input is read once for every part.
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import resource
+import threading
+import multiprocessing
+from collections import OrderedDict
+
+import generate
+from generate import InputReader, Writer, chunks
+
+
+def parse_size(size):
+    """Number of bytes of a size such as 512M or 12G, plain numbers are MB."""
+    size = str(size).strip().upper().rstrip('B')
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(float(size) * units['M'])
+
+
+def job_arguments(settings):
+    """The command line arguments of generate.py for the settings of a job."""
+    arguments = list()
+    for key, value in settings.items():
+        if key in ('name', 'data', 'memory') or value is None or value is False:
+            continue
+        option = '--' + key.replace('_', '-')
+        if value is True:
+            arguments.append(option)
+        elif isinstance(value, list):
+            arguments.append(option)
+            arguments.extend(str(item) for item in value)
+        else:
+            arguments.extend((option, str(value)))
+    return arguments
+
+
+class Job:
+
+    def __init__(self, index, settings):
+        self.name = settings.get('name', 'job {}'.format(index + 1))
+        data = settings.get('data')
+        self.data = (data,) if isinstance(data, str) else tuple(data or ())
+        self.memory = parse_size(settings['memory']) if settings.get('memory') else 0
+        parser = argparse.ArgumentParser(prog=self.name)
+        generate.add_resource_arguments(parser)
+        parser.add_argument('--output-clean', required=True)
+        parser.add_argument('--output-noisy', required=True)
+        parser.set_defaults(debug=False)
+        self.args = parser.parse_args(job_arguments(settings))
+        if not self.data:
+            parser.error('no data given')
+        if self.args.lm_context < 1:
+            parser.error('--lm-context must be at least 1')
+
+    def run(self, tweets):
+        """Processes the batches of tokenized tweets from the queue, until None."""
+        if self.memory:
+            resource.setrlimit(resource.RLIMIT_AS, (self.memory, self.memory))
+        generate.args = self.args
+        generate.deduplicator = None
+        generate.load_resources(self.args)
+        with Writer(self.args.output_noisy) as out_noisy, Writer(self.args.output_clean) as out_clean:
+            generate.out_noisy = out_noisy
+            generate.out_clean = out_clean
+            for batch in iter(tweets.get, None):
+                for tweet, tokens in batch:
+                    generate.process_tweet(tweet, tokens)
+        if self.args.candidate_cache:
+            generate.save_candidate_cache(self.args.candidate_cache)
+        print('Finished {}'.format(self.name), file=sys.stderr)
+        generate.report_statistics(generate.take_statistics())
+
+
+class Pass:
+    """
+    Reads and tokenizes an input once, for a group of jobs which run at the
+    same time, each in its own process.
+    """
+
+    def __init__(self, data, jobs, chunk_size, readers, finished):
+        self.data = data
+        self.jobs = jobs
+        self.chunk_size = chunk_size
+        self.readers = readers
+        self.finished = finished
+        # Started fresh, instead of forked from a process with running threads
+        context = multiprocessing.get_context('spawn')
+        self.queues = [context.Queue(8) for _ in jobs]
+        self.processes = [context.Process(target=job.run, args=(tweets,), name=job.name)
+                          for job, tweets in zip(jobs, self.queues)]
+
+    def start(self):
+        for job, process, tweets in zip(self.jobs, self.processes, self.queues):
+            process.start()
+            threading.Thread(target=self._wait, args=(job, process, tweets), daemon=True).start()
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _wait(self, job, process, tweets):
+        process.join()
+        # Batches which a failed job did not take would otherwise block the exit
+        tweets.cancel_join_thread()
+        self.finished.put((job, process.exitcode))
+
+    def _send(self, batch):
+        for tweets, process in zip(self.queues, self.processes):
+            # Jobs which failed are skipped, instead of waiting for them forever
+            while process.is_alive():
+                try:
+                    tweets.put(batch, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+
+    def _read(self):
+        try:
+            for batch in chunks(InputReader(list(self.data), self.readers), self.chunk_size):
+                tokenized = list()
+                for tweet in batch:
+                    tokens = generate.tokenize_tweet(tweet)
+                    if tokens is not None:
+                        tokenized.append((tweet, tokens))
+                self._send(tokenized)
+        except Exception as e:
+            print('Reading {} failed: {!r}'.format(', '.join(self.data), e), file=sys.stderr)
+            for process in self.processes:
+                process.terminate()
+        finally:
+            self._send(None)
+
+
+def schedule(jobs, workers, memory, chunk_size, readers):
+    """
+    Runs all jobs, returns the names of the jobs which failed.
+
+    Every started group is a Pass of its own, with a process per job, which
+    reads its input again. A group which fits the workers and the total memory
+    waits until it can be started as a whole, instead of running part of it
+    now and reading the input again for the rest; only a group which can never
+    fit is split, and then its input is read more than once.
+    """
+    failed = list()
+    for job in jobs:
+        if job.memory > memory:
+            print('{} needs more memory than the total budget'.format(job.name), file=sys.stderr)
+            failed.append(job.name)
+    pending = sorted((job for job in jobs if job.memory <= memory), key=lambda job: -job.memory)
+    running = list()
+    finished = queue.Queue()
+    start = time.perf_counter()
+    while pending or running:
+        free_workers = workers - len(running)
+        free_memory = memory - sum(job.memory for job in running)
+        groups = OrderedDict()
+        for job in pending:
+            groups.setdefault(job.data, list()).append(job)
+        # Largest groups first, each with as many of its jobs as fit
+        for data, group in sorted(groups.items(), key=lambda item: -sum(job.memory for job in item[1])):
+            selected = list()
+            selected_memory = 0
+            for job in group:
+                if len(selected) < free_workers and selected_memory + job.memory <= free_memory:
+                    selected.append(job)
+                    selected_memory += job.memory
+            fits = len(group) <= workers and sum(job.memory for job in group) <= memory
+            if not selected or fits and len(selected) < len(group):
+                continue
+            free_workers -= len(selected)
+            free_memory -= selected_memory
+            for job in selected:
+                pending.remove(job)
+                running.append(job)
+            print('Starting {} on {} ({:.0f}s)'.format(', '.join(job.name for job in selected),
+                                                       ', '.join(data), time.perf_counter() - start),
+                  file=sys.stderr)
+            Pass(data, selected, chunk_size, readers, finished).start()
+        job, exitcode = finished.get()
+        running.remove(job)
+        if exitcode != 0:
+            print('{} failed with exit code {}'.format(job.name, exitcode), file=sys.stderr)
+            failed.append(job.name)
+    return failed
+
+
+def total_memory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run several generate.py configurations from a job file')
+    parser.add_argument('jobs',
+                        help='JSON job file')
+    parser.add_argument('--workers',
+                        type=int,
+                        help='Number of jobs running at the same time (default: from the job file, or the number of cores)')
+    parser.add_argument('--memory',
+                        help='Total memory budget of the running jobs, e.g. 60G (default: from the job file, '
+                             'or the physical memory)')
+    parser.add_argument('--chunk-size',
+                        type=int,
+                        default=1000,
+                        help='Number of tweets sent to a job at once')
+    parser.add_argument('--readers',
+                        type=int,
+                        default=2,
+                        help='Number of input files read and decompressed ahead per input')
+    args = parser.parse_args()
+    with open(args.jobs, 'r', encoding='utf-8') as f:
+        job_file = json.load(f)
+    jobs = [Job(index, settings) for index, settings in enumerate(job_file['jobs'])]
+    workers = args.workers or job_file.get('workers') or os.cpu_count()
+    memory = parse_size(args.memory or job_file['memory']) if args.memory or job_file.get('memory') else total_memory()
+    failed = schedule(jobs, workers, memory, args.chunk_size, args.readers)
+    if failed:
+        print('Failed: {}'.format(', '.join(failed)), file=sys.stderr)
+        sys.exit(1)
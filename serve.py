@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+Keeps the resources of generate.py loaded and serves the normalizations of
+tweets as JSON over HTTP, on a TCP port or a Unix socket.
+
+    POST /normalize  {"tweets": [...]}  cleans tweets with OOV tokens and noisifies the others
+    POST /clean      {"tweets": [...]}  only cleans
+    POST /noisify    {"tweets": [...]}  only noisifies, the OOV tokens are left alone
+    GET  /health
+    GET  /statistics
+
+Requests which arrive together are processed as one batch, by a single
+thread which owns the resources. The candidates of all tweets in a batch are
+generated in one pass, with one word embedding lookup, and the language model
+windows which are certainly scored are scored together, grouped by context.
+"""
+
+import sys
+import json
+import asyncio
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import generate
+
+
+class TokenPairCollector:
+    """Takes the place of the output writers, and keeps the token pairs of the last tweet."""
+
+    def __init__(self):
+        self.block = list()
+        self.tweet = None
+
+    def writeTokenPair(self, original, normalized, status='-'):
+        self.block.append({'noisy': original,
+                           'clean': normalized,
+                           'status': status})
+
+    def newline(self):
+        self.tweet = self.block
+        self.block = list()
+
+    def take(self):
+        tweet = self.tweet
+        self.tweet = None
+        return tweet
+
+
+def classify(tweet, mode):
+    """
+    The mode, tokens, OOV and IV tokens of a tweet; with mode 'normalize', it
+    is cleaned when it has OOV tokens and noisified otherwise, like
+    generate.py does. The tokens are None when the tweet is skipped.
+    """
+    tokens = generate.tokenize_tweet(tweet)
+    if tokens is None:
+        return None, None, dict(), dict()
+    oov, iv = generate.classify_tokens(tokens)
+    if mode == 'normalize':
+        mode = 'clean' if oov else 'noisify'
+    return mode, tokens, oov, iv
+
+
+def normalize(tweet, mode, tokens, oov, iv):
+    """
+    Cleans or noisifies a classified tweet. The status of a token pair is
+    'OOV' when the token was changed, as in the output files of generate.py,
+    and oov tells whether the token is OOV.
+    """
+    if tokens is None:
+        return {'tweet': tweet, 'mode': None, 'changed': False, 'score': None, 'tokens': []}
+    score = None
+    tracer = generate.SourceTracer()
+    if mode == 'clean' and oov:
+        score = generate.clean(tweet, oov, tokens, tracer)
+        pairs = generate.out_noisy.take()
+    elif mode == 'noisify' and iv:
+        score = generate.noisify(tweet, iv, tokens, tracer)
+        pairs = generate.out_clean.take()
+    else:
+        pairs = None
+    if pairs is None:
+        score = None
+        pairs = [{'noisy': token, 'clean': token, 'status': 'IV'} for token in tokens]
+    for index, pair in enumerate(pairs):
+        changed = pair['clean'] if mode == 'clean' else pair['noisy']
+        pair['sources'] = sorted(tracer.get_sources(index, changed)) if pair['status'] == 'OOV' else []
+        pair['oov'] = index in oov
+    return {'tweet': tweet, 'mode': mode, 'changed': score is not None, 'score': score, 'tokens': pairs}
+
+
+class Batcher:
+    """
+    Collects the tweets of concurrent requests for up to max_delay seconds, or
+    until there are max_size of them, and processes them as one batch on one
+    thread, which owns the resources. Identical tweets in a batch are only
+    processed once. The statistics are only updated on the event loop.
+    """
+
+    def __init__(self, max_size, max_delay):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(1)
+        self.statistics = Counter()
+
+    async def submit(self, mode, tweets):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((mode, tweets, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await self.queue.get()]
+            size = len(requests[0][1])
+            deadline = loop.time() + self.max_delay
+            while size < self.max_size:
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+                requests.append(request)
+                size += len(request[1])
+            try:
+                results, statistics = await loop.run_in_executor(
+                    self.executor, self.process, [(mode, tweets) for mode, tweets, _ in requests])
+            except Exception as e:
+                for _, _, future in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.statistics.update(statistics)
+            for (_, _, future), result in zip(requests, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def process(self, requests):
+        """
+        Returns the results of the requests, and the statistics of processing
+        them. The candidates of all tweets in the batch are generated, and
+        their language model windows scored, in one pass before the tweets are
+        normalized.
+        """
+        classified = dict()
+        for mode, tweets in requests:
+            for tweet in tweets:
+                if (mode, tweet) not in classified:
+                    classified[mode, tweet] = classify(tweet, mode)
+        generate.prepare_tweets([tweet for tweet in classified.values() if tweet[1] is not None])
+        results = {(mode, tweet): normalize(tweet, *classified[mode, tweet]) for mode, tweet in classified}
+        statistics = Counter(generate.take_statistics())
+        statistics['requests'] += len(requests)
+        statistics['batches'] += 1
+        statistics['tweets'] += len(results)
+        return [[results[mode, tweet] for tweet in tweets] for mode, tweets in requests], statistics
+
+
+class Server:
+
+    modes = ('normalize', 'clean', 'noisify')
+    reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               500: 'Internal Server Error'}
+
+    def __init__(self, batcher):
+        self.batcher = batcher
+
+    async def route(self, method, path, body):
+        """Returns the HTTP status and the JSON response of a request."""
+        path = path.split('?', 1)[0].strip('/')
+        if path == 'health':
+            return 200, {'status': 'ok'}
+        if path == 'statistics':
+            return 200, dict(self.batcher.statistics)
+        if path not in self.modes:
+            return 404, {'error': 'Unknown path: /{}'.format(path)}
+        if method != 'POST':
+            return 405, {'error': 'Use POST to /{}'.format(path)}
+        try:
+            request = json.loads(body)
+            tweets = request['tweets'] if 'tweets' in request else [request['tweet']]
+            if not isinstance(tweets, list):
+                raise TypeError('tweets must be a list')
+            if not all(isinstance(tweet, str) for tweet in tweets):
+                raise TypeError('tweets must be strings')
+        except (ValueError, KeyError, TypeError) as e:
+            return 400, {'error': 'Expected {{"tweets": [...]}}: {}'.format(e)}
+        try:
+            return 200, {'results': await self.batcher.submit(path, tweets)}
+        except Exception as e:
+            return 500, {'error': repr(e)}
+
+    async def handle(self, reader, writer):
+        """Serves the HTTP/1.1 requests of a connection, until it is closed."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    method, path, version = request_line.decode('latin-1').split()
+                    body = await reader.readexactly(int(headers.get('content-length', 0)))
+                except ValueError:
+                    status, response = 400, {'error': 'Malformed request'}
+                    version = 'HTTP/1.0'
+                else:
+                    status, response = await self.route(method, path, body)
+                payload = json.dumps(response, ensure_ascii=False).encode('utf-8')
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(
+                                 status, self.reasons[status], len(payload)).encode('latin-1') + payload)
+                await writer.drain()
+                if version == 'HTTP/1.0' or headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(args):
+    batcher = Batcher(args.batch_size, args.batch_delay / 1000)
+    server = Server(batcher)
+    if args.socket:
+        listener = await asyncio.start_unix_server(server.handle, path=args.socket)
+        print('Listening on {}'.format(args.socket), file=sys.stderr)
+    else:
+        listener = await asyncio.start_server(server.handle, args.host, args.port)
+        print('Listening on http://{}:{}'.format(args.host, args.port), file=sys.stderr)
+    async with listener:
+        await asyncio.gather(listener.serve_forever(), batcher.run())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the normalizations of tweets over HTTP')
+    generate.add_resource_arguments(parser)
+    parser.add_argument('--host',
+                        default='127.0.0.1',
+                        help='Address to listen on')
+    parser.add_argument('--port',
+                        type=int,
+                        default=8080,
+                        help='Port to listen on')
+    parser.add_argument('--socket',
+                        help='Listen on this Unix socket instead of a TCP port')
+    parser.add_argument('--batch-size',
+                        type=int,
+                        default=64,
+                        help='Maximum number of tweets processed in one batch')
+    parser.add_argument('--batch-delay',
+                        type=float,
+                        default=5,
+                        help='Number of milliseconds to wait for more requests to add to a batch')
+    parser.set_defaults(debug=False)
+    args = parser.parse_args()
+    if args.lm_context < 1:
+        parser.error('--lm-context must be at least 1')
+    generate.args = args
+    generate.out_noisy = TokenPairCollector()
+    generate.out_clean = TokenPairCollector()
+    generate.load_resources(args)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
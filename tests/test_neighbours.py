@@ -0,0 +1,87 @@
+import array
+import random
+
+import pytest
+
+try:
+    from embeddings import Embeds
+except OSError:
+    # The library is not compiled (embeddings/compile.sh)
+    Embeds = None
+
+pytestmark = pytest.mark.skipif(Embeds is None, reason='the embeddings library is not compiled')
+
+
+def write_model(path, words, size, clusters, seed, names=()):
+    """
+    A binary word2vec model of words scattered around random cluster centres,
+    the first of which are named by the given byte strings.
+    """
+    rng = random.Random(seed)
+    centres = [[rng.gauss(0, 1) for _ in range(size)] for _ in range(clusters)]
+    with open(path, 'wb') as f:
+        f.write('{} {}\n'.format(words, size).encode('utf-8'))
+        for index in range(words):
+            centre = centres[rng.randrange(clusters)]
+            f.write(names[index] if index < len(names) else 'w{}'.format(index).encode('utf-8'))
+            f.write(b' ')
+            f.write(array.array('f', [value + rng.gauss(0, 0.6) for value in centre]).tobytes())
+            f.write(b'\n')
+
+
+@pytest.fixture(scope='module')
+def embeddings(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('neighbours') / 'model.bin')
+    write_model(path, words=20000, size=32, clusters=400, seed=1)
+    embeddings = Embeds()
+    embeddings.loadW2V(path)
+    embeddings.buildIndex(trees=10, seed=1)
+    return embeddings
+
+
+def recall(embeddings, words):
+    """Fraction of the exact neighbours of the words which the forest finds."""
+    found = 0
+    total = 0
+    for word in words:
+        expected = {candidate for candidate, _ in embeddings.search(word, exact=True)}
+        found += len(expected & {candidate for candidate, _ in embeddings.search(word)})
+        total += len(expected)
+    return found / total
+
+
+def test_recall(embeddings):
+    words = random.Random(2).sample(embeddings.vocabulary[1:], 200)
+    assert recall(embeddings, words) >= 0.9
+
+
+def test_recall_grows_with_search_k(embeddings):
+    words = random.Random(3).sample(embeddings.vocabulary[1:], 100)
+    embeddings.setSearchK(640)
+    low = recall(embeddings, words)
+    embeddings.setSearchK(0)
+    assert recall(embeddings, words) > low
+
+
+def test_index_round_trip(embeddings, tmp_path):
+    path = str(tmp_path / 'model.bin.ann')
+    embeddings.saveIndex(path)
+    words = random.Random(4).sample(embeddings.vocabulary[1:], 20)
+    before = [embeddings.search(word) for word in words]
+    assert embeddings.loadIndex(path)
+    assert [embeddings.search(word) for word in words] == before
+
+
+def test_unknown_word(embeddings):
+    assert embeddings.search('not-a-word') is None
+
+
+def test_word_cut_in_a_character(tmp_path):
+    path = str(tmp_path / 'cut.bin')
+    # word2vec cut this word in the middle of the two bytes of an e acute
+    write_model(path, words=100, size=8, clusters=5, seed=5, names=[b'caf\xc3'])
+    embeddings = Embeds()
+    embeddings.loadW2V(path)
+    assert embeddings.vocabulary[1] == 'caf\ufffd'
+    neighbours = embeddings.find_many(['w10', 'w20'])
+    assert len(neighbours) == 2 and all(neighbours)
@@ -0,0 +1,67 @@
+import argparse
+import multiprocessing
+from collections import Counter
+
+import pytest
+
+import generate
+from generate import Quota, Writer, BufferWriter
+
+
+def fake_process_tweet(tweet, tokens=None, clean_wanted=True, noisify_wanted=True):
+    """Cleans the tweets starting with 'c' and noisifies the others, like tweets with and without OOV tokens."""
+    if tweet.startswith('c'):
+        if clean_wanted:
+            generate.out_noisy.writeTokenPair(tweet, tweet.upper(), 'OOV')
+            generate.out_noisy.newline()
+    elif noisify_wanted:
+        generate.out_clean.writeTokenPair(tweet.upper(), tweet, 'OOV')
+        generate.out_clean.newline()
+
+
+def init_fake_worker():
+    generate.out_noisy = BufferWriter()
+    generate.out_clean = BufferWriter()
+
+
+class Position:
+    position = (0, 0)
+
+
+@pytest.fixture
+def fake_generate(monkeypatch):
+    # Mostly tweets to clean, so most of them are still processed after the noisy target is met
+    tweets = ['c{}'.format(index) if index % 4 else 'n{}'.format(index) for index in range(400)]
+    monkeypatch.setattr(generate, 'process_tweet', fake_process_tweet)
+    monkeypatch.setattr(generate, 'select_tweets', lambda: ((0, tweet, None) for tweet in tweets))
+    monkeypatch.setattr(generate, 'take_statistics', Counter)
+    # The globals which generate.py only sets when run as a script
+    monkeypatch.setattr(generate, 'input_file', Position(), raising=False)
+    for name in ('checkpoint', 'profile', 'deduplicator', 'quota', 'out_noisy', 'out_clean'):
+        monkeypatch.setattr(generate, name, None, raising=False)
+
+
+def run(tmp_path, name, workers, target_clean, target_noisy):
+    args = argparse.Namespace(workers=workers, chunk_size=7, candidate_cache=None, data=['tweets'])
+    generate.quota = Quota(target_clean, target_noisy, 1)
+    with Writer(str(tmp_path / (name + '.noisy'))) as generate.out_noisy, \
+            Writer(str(tmp_path / (name + '.clean'))) as generate.out_clean:
+        if workers > 1:
+            # Forked, so the workers have the fakes as well
+            pool = multiprocessing.get_context('fork').Pool(workers, initializer=init_fake_worker)
+            generate.main_parallel(args, pool)
+        else:
+            generate.main(args)
+    return [(tmp_path / (name + suffix)).read_text() for suffix in ('.noisy', '.clean')]
+
+
+@pytest.mark.parametrize('target_clean, target_noisy', [(None, 20), (30, None), (30, 20)])
+def test_workers_meet_quota_like_a_single_process(fake_generate, tmp_path, target_clean, target_noisy):
+    serial = run(tmp_path, 'serial', 1, target_clean, target_noisy)
+    parallel = run(tmp_path, 'parallel', 3, target_clean, target_noisy)
+    assert parallel == serial
+    noisy, clean = serial
+    if target_noisy is not None:
+        assert clean.count('\n\n') == target_noisy
+    if target_clean is not None:
+        assert noisy.count('\n\n') == target_clean
@@ -0,0 +1,43 @@
+import pytest
+
+from generate import Writer
+
+
+class FailingFile:
+    """Stands in for the output file of a writer, on a full disk."""
+
+    def __init__(self):
+        self.closed = False
+
+    def write(self, data):
+        raise OSError('No space left on device')
+
+    def close(self):
+        self.closed = True
+
+
+def failing_writer(path):
+    writer = Writer(path, buffer_size=1).__enter__()
+    writer.file.close()
+    writer.file = FailingFile()
+    writer.write('token\tIV\ttoken\n\n')
+    # Until the writer thread has failed on it
+    writer.batches.join()
+    return writer
+
+
+def test_writer_error_is_raised_after_closing(tmp_path):
+    writer = failing_writer(str(tmp_path / 'out.clean'))
+    with pytest.raises(OSError):
+        writer.__exit__(None, None, None)
+    assert writer.file.closed
+    assert not writer.thread.is_alive()
+
+
+def test_writer_error_does_not_hide_the_error_of_the_with_block(tmp_path):
+    writer = failing_writer(str(tmp_path / 'out.clean'))
+    error = KeyError('original')
+    # As a with block which raised error exits, the writer lets it through
+    assert writer.__exit__(KeyError, error, None) is False
+    assert writer.file.closed
+    assert not writer.thread.is_alive()
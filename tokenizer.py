@@ -1,60 +1,89 @@
 #!/usr/bin/env python3
 
 import sys
-import re
-
-emoticon_string = r"""
-    (?:
-      [<>]?
-      [:;=8>xX]                    # eyes
-      [\-o\*\']?                 # optional nose
-      [\)\]\(\[dDpPxX/\:\}\{@\|\\S] # mouth      
-      |
-      [\)\]\(\[dDpPxX/\:\}\{@\|\\S] # mouth
-      [\-o\*\']?                 # optional nose
-      [:;=8<xX]                    # eyes
-      [<>]?
-      |
-      <[/\\]?3                         # heart(added: has)
-      |
-      \(?\(?\#?                   #left cheeck
-      [>\-\^\*\+o\~]              #left eye
-      [\_\.\|oO\,]                #nose
-      [<\-\^\*\+o\~]              #right eye
-      [\#\;]?\)?\)?               #right cheek
-    )"""
-
-emoticon_re = re.compile(emoticon_string, re.VERBOSE | re.I | re.UNICODE)
-
-def is_emoticon(token):
-    return re.match(emoticon_re, token) is not None
-
-def preprocess(tokens):
-    cleaner = list()
-    for token in tokens:
-        token = re.sub('[`’]', '\'', token)
-        if token[:1] == '#' or token[:1] == '@' or 'http' in token:
-            cleaner.append(token)
-        elif is_emoticon(token):
-            cleaner.append(token)
-        else:
-            for part in re.findall(
-                        r"<[UR]>|\d[\d\-/':.,]+\d|\w[\w']*\w|[.,!?;:\"\'()/\\]+|\S",
-                        token):
-                    if part:
-                        if part.isupper() and not re.match(r"<[UR]>", token):
-                            cleaner.append(part.lower())
-                        else:
-                            cleaner.append(part)
-    return cleaner
+import io
+import os
+import argparse
+import multiprocessing
+from collections import deque
+
+from generate import Preprocessor
+
+# The same tokenization as generate.py, so the tokens match those of the clusters
+is_emoticon = Preprocessor.is_emoticon
+preprocess_line = Preprocessor.preprocess_line
+preprocess = Preprocessor.preprocess
 
 
 def main(stdin):
     for line in stdin:
-        tokens = line.split()
-        tokens = preprocess(tokens)
+        tokens = preprocess_line(line)
         print(' '.join(tokens))
 
 
+def byte_ranges(path, size):
+    """Splits a file into ranges of about size bytes, which start and end at line boundaries."""
+    with open(path, 'rb') as f:
+        total = os.fstat(f.fileno()).st_size
+        start = 0
+        while start < total:
+            if start + size >= total:
+                end = total
+            else:
+                f.seek(start + size - 1)
+                f.readline()
+                end = f.tell()
+            yield start, end
+            start = end
+
+
+def tokenize_range(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    output = io.StringIO()
+    for line in io.TextIOWrapper(io.BytesIO(data), encoding='utf-8', newline='\n'):
+        output.write(' '.join(preprocess_line(line)))
+        output.write('\n')
+    return output.getvalue()
+
+
+def main_parallel(path, workers, chunk_size):
+    """
+    Tokenizes byte ranges of a file in worker processes, and writes the
+    results in the order of the file.
+    """
+    with multiprocessing.Pool(workers) as pool:
+        # Only keep a few ranges per worker in flight to bound memory usage
+        pending = deque()
+        for start, end in byte_ranges(path, chunk_size):
+            pending.append(pool.apply_async(tokenize_range, (path, start, end)))
+            if len(pending) >= 2 * workers:
+                sys.stdout.write(pending.popleft().get())
+        while pending:
+            sys.stdout.write(pending.popleft().get())
+
+
 if __name__ == '__main__':
-    main(sys.stdin)
+    parser = argparse.ArgumentParser(description='Tokenizes tweets, one tweet per line')
+    parser.add_argument('input',
+                        nargs='?',
+                        help='The file containing the tweets (default: standard input)')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='Number of processes, which each tokenize a byte range of the input file')
+    parser.add_argument('--chunk-size',
+                        type=int,
+                        default=8 * 1024 * 1024,
+                        help='Size in bytes of the ranges given to the workers')
+    args = parser.parse_args()
+    if args.workers > 1:
+        if not args.input:
+            parser.error('--workers requires an input file')
+        main_parallel(args.input, args.workers, args.chunk_size)
+    elif args.input:
+        with open(args.input, 'r', encoding='utf-8', newline='\n') as f:
+            main(f)
+    else:
+        main(sys.stdin)